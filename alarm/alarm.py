@@ -1,8 +1,14 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-import gpiozero
+import datetime
+import heapq
+import itertools
+import json
 import os
+import re
+import selectors
 import signal
+import socket
 import subprocess
 import sys
 import time
@@ -32,102 +38,601 @@ ICY-META: StreamTitle='';StreamUrl='';metadata='adswizzContext=fGg6MV58cDo0OTU2N
 
 ICY-META: StreamTitle='Good Night and Good Rest - John Johnson';StreamUrl='';
 
+The daemon owns the alarm schedule, so cron is no longer needed. Everything
+(alarm timers, signals, the button, the player exiting and commands on the
+control socket) is handled by one event loop that sleeps until the next
+thing happens.
+
+Alarms don't wait for the stream. The player (mpg123 in remote control mode)
+is started at zero volume prebuffer seconds ahead of a scheduled alarm. It
+is turned up at the alarm time once the stream is actually decoding, or as
+soon as any advertisement announced in the ICY metadata (adw_ad='true' or
+insertionType='preroll' above) is over. If the stream hasn't started
+start_deadline seconds after the alarm time, or it fails, the local
+fallback_file is played instead so the alarm still sounds on time. If the
+fallback file is missing or won't play, a failed stream is retried until
+the alarm is due and a few more times after that.
+fake_stream.py serves a local stand-in stream for testing.
+
+    alarm.py daemon             run the daemon
+    alarm.py                    sound the alarm now (what cron used to run)
+    alarm.py add 06:30 0,1,2,3,4
+                                alarm at 6:30 on weekdays (0 is monday),
+                                every day if no days are given
+    alarm.py remove 06:30       remove the 6:30 alarm
+    alarm.py list|play|stop|mute|unmute|status
+
 '''
 
 pid_file = '/tmp/alarm.pid'
-alarm = False
-play = False
-
-def handle_signal(signum, stack):
-    global alarm
-    global play
-    if not alarm and not play:
-        alarm = True
-
-def handle_button():
-    global alarm
-    global play
-    if alarm or play:
-        alarm = False
-        play = False
-    else:
-        play = True
+control_socket = '/tmp/alarm.sock'
+schedule_file = '/var/lib/alarm/schedule.json'
+stream_url = 'http://cms.stream.publicradio.org/cms.mp3'
+mixer_control = 'Headphone'
+button_pin = 26
+fallback_file = '/home/pi/alarm.mp3' # played if the stream isn't playing on time
+prebuffer = 60 # seconds before a scheduled alarm to start the stream silently
+start_deadline = 10 # seconds after the alarm is due to wait for the stream
+meta_wait = 2 # seconds after decoding starts to wait for the first ICY metadata
+ad_timeout = 60 # seconds to stay silent for an advertisement without a duration
+alarm_length = 3600 # seconds before an unattended alarm stops itself
+max_timer = 600 # seconds, longest wait before the schedule is rechecked
+stream_retries = 3 # times to retry a failed stream after the alarm is due when there is no fallback
+stream_retry_delay = 10 # seconds between stream retries
 
-def main(args):
-    global pid_file
-    global alarm
-    global play
+def log(msg):
+    ts = time.strftime('%Y-%m-%d %H:%M:%S')
+    print('%s %s' % (ts, msg))
+    sys.stdout.flush()
 
-    pid = None
+def set_mute(muted):
     try:
-        with open(pid_file, 'r') as fin:
-            pid = fin.read()
-    except IOError:
-        pass
+        subprocess.call(['amixer', '-q', 'set', mixer_control, 'mute' if muted else 'unmute'])
+    except OSError as e:
+        log('amixer failed: %s' % e)
 
-    if 'daemon' in args:
-        if pid:
-            print 'alarm daemon is already running pid=%s' % pid
-            return 1
+def make_entry(when, days=None):
+    ''' return a schedule entry with the time as HH:MM, raise ValueError or TypeError if it's invalid '''
+    entry = { 'time' : datetime.datetime.strptime(when, '%H:%M').strftime('%H:%M') }
+    if days is not None:
+        entry['days'] = [int(d) for d in days]
+        if not all(0 <= d <= 6 for d in entry['days']):
+            raise ValueError('days must be 0 to 6')
+    return entry
+
+def next_alarm_time(entry, now):
+    ''' next datetime after now matching a schedule entry '''
+    hour, minute = (int(x) for x in entry['time'].split(':'))
+    days = entry.get('days') or range(7)
+    candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    for i in range(8):
+        day = candidate + datetime.timedelta(days=i)
+        if day > now and day.weekday() in days:
+            return day
+    return None
+
+class Timers:
+    ''' heap of pending callbacks keyed by monotonic time '''
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+
+    def add(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self.seq), callback]
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def cancel(self, timer):
+        # cancelled timers stay in the heap but do nothing when they expire
+        if timer:
+            timer[2] = None
+
+    def timeout(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def run_due(self):
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            callback = heapq.heappop(self.heap)[2]
+            if callback:
+                callback()
+
+class Player:
+    ''' mpg123 in generic remote control mode '''
+    def __init__(self, selector, handler):
+        self.selector = selector
+        self.handler = handler
+        self.proc = subprocess.Popen(['mpg123', '-R'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.buf = b''
+        self.selector.register(self.proc.stdout, selectors.EVENT_READ, self.handle_output)
+        # no @F frame messages, only state changes
+        self.send('SILENCE')
+
+    def send(self, cmd):
+        try:
+            self.proc.stdin.write((cmd + '\n').encode('utf-8'))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass # the exit is reported through handle_output
+
+    def load(self, url):
+        self.send('LOAD %s' % url)
+
+    def volume(self, percent):
+        self.send('VOLUME %d' % percent)
+
+    def handle_output(self, fileobj):
+        try:
+            data = os.read(fileobj.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            self.close()
+            self.handler(None)
+            return
+        self.buf += data
+        *lines, self.buf = self.buf.split(b'\n')
+        for line in lines:
+            # the handler may have replaced this player
+            if self.proc.stdout.closed:
+                return
+            self.handler(line.decode('utf-8', 'replace').strip())
+
+    def close(self):
+        if self.proc.stdout.closed:
+            return
+        self.selector.unregister(self.proc.stdout)
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stdin.close()
+
+class AlarmDaemon:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = Timers()
+        self.events = []
+        self.schedule = []
+        self.schedule_timers = []
+        self.player = None
+        self.alarm = False # current playback was started by an alarm
+        self.due = False # playback is supposed to be audible
+        self.stream_started = False
+        self.in_ad = False
+        self.fallback = False
+        self.fallback_failed = False
+        self.retries = 0
+        self.audible = None
+        self.muted = False # mixer muted by the user
+        self.due_timer = None
+        self.deadline_timer = None
+        self.start_timer = None
+        self.stop_timer = None
+        self.ad_timer = None
+        self.retry_timer = None
+        self.running = True
+
+        # signals and other threads wake the loop through this pipe
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.handle_wakeup)
+
+    def post(self, event):
+        ''' queue an event from a signal handler or another thread '''
+        self.events.append(event)
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def setup_signals(self):
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGUSR1, lambda signum, stack: self.post('alarm'))
+        signal.signal(signal.SIGCHLD, lambda signum, stack: self.post('child'))
+        signal.signal(signal.SIGTERM, lambda signum, stack: self.post('quit'))
+        signal.signal(signal.SIGINT, lambda signum, stack: self.post('quit'))
+
+    def setup_button(self):
+        try:
+            import gpiozero
+        except ImportError:
+            log('gpiozero not available, running without the button')
+            return
+        self.button = gpiozero.Button(button_pin)
+        # gpiozero calls this from its own thread
+        self.button.when_pressed = lambda: self.post('button')
+
+    def setup_control(self):
+        try:
+            os.unlink(control_socket)
+        except FileNotFoundError:
+            pass
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.bind(control_socket)
+        self.control.listen(4)
+        self.control.setblocking(False)
+        self.selector.register(self.control, selectors.EVENT_READ, self.handle_accept)
+
+    def load_schedule(self):
+        try:
+            with open(schedule_file) as fin:
+                schedule = json.loads(fin.read())
+        except FileNotFoundError:
+            schedule = []
+        except (OSError, ValueError) as e:
+            log('ignoring %s: %s' % (schedule_file, e))
+            schedule = []
+        if not isinstance(schedule, list):
+            log('ignoring %s: not a list of alarms' % schedule_file)
+            schedule = []
+        # a hand edited entry that's wrong is skipped instead of stopping
+        # every other alarm
+        self.schedule = []
+        for entry in schedule:
+            try:
+                self.schedule.append(make_entry(entry['time'], entry.get('days')))
+            except (KeyError, TypeError, ValueError) as e:
+                log('skipping invalid alarm %s: %s' % (json.dumps(entry), e))
+        self.arm_schedule()
+
+    def save_schedule(self):
+        os.makedirs(os.path.dirname(schedule_file), exist_ok=True)
+        with open(schedule_file + '.tmp', 'w') as fout:
+            fout.write(json.dumps(self.schedule, indent=4))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(schedule_file + '.tmp', schedule_file)
+
+    def arm_schedule(self):
+        for timer in self.schedule_timers:
+            self.timers.cancel(timer)
+        self.schedule_timers = []
+        for entry in self.schedule:
+            self.arm_entry(entry)
+
+    def arm_entry(self, entry, after=None):
+        now = datetime.datetime.now()
+        when = next_alarm_time(entry, max(now, after or now))
+        if when is None:
+            return
+        start_at = when - datetime.timedelta(seconds=prebuffer)
+        def fire():
+            self.schedule_timers.remove(timer)
+            now = datetime.datetime.now()
+            if now >= start_at:
+                log('scheduled alarm %s' % entry['time'])
+                self.start(alarm=True, due_in=(when - now).total_seconds())
+                self.arm_entry(entry, after=when)
+            else:
+                self.arm_entry(entry, after=after)
+        # timers run on the monotonic clock, so check back at least every
+        # max_timer seconds in case the wall clock was set (ntp after boot)
+        delay = min((start_at - now).total_seconds(), max_timer)
+        timer = self.timers.add(max(delay, 0.0), fire)
+        self.schedule_timers.append(timer)
+
+    def start(self, alarm, due_in=0.0):
+        ''' start playing, an alarm stays silent until it is due and the stream is really playing '''
+        if self.player or self.retry_timer:
+            return
+        self.alarm = alarm
+        self.due = not alarm
+        self.stream_started = False
+        self.in_ad = False
+        self.fallback = False
+        self.fallback_failed = False
+        self.retries = 0
+        self.audible = None
+        if alarm:
+            self.due_timer = self.timers.add(due_in, self.handle_due)
+            self.deadline_timer = self.timers.add(due_in + start_deadline, self.handle_deadline)
+            self.stop_timer = self.timers.add(due_in + alarm_length, self.stop)
+        self.open_player(stream_url)
+
+    def open_player(self, url):
+        if self.player:
+            self.player.close()
+        self.player = Player(self.selector, self.handle_player)
+        log('loading %s (pid %d)' % (url, self.player.proc.pid))
+        self.audible = None
+        self.update_volume()
+        self.player.load(url)
+
+    def can_fall_back(self):
+        if self.fallback_failed:
+            return False
+        if not os.access(fallback_file, os.R_OK):
+            log('fallback %s is not readable' % fallback_file)
+            self.fallback_failed = True
+            return False
+        return True
+
+    def play_fallback(self):
+        log('falling back to %s' % fallback_file)
+        self.fallback = True
+        self.in_ad = False
+        for timer in (self.deadline_timer, self.start_timer, self.ad_timer):
+            self.timers.cancel(timer)
+        self.open_player(fallback_file)
+
+    def handle_failure(self):
+        ''' the stream or the fallback stopped playing during an alarm '''
+        if not self.fallback and self.can_fall_back():
+            self.play_fallback()
+            return
+        # retries only count once the alarm is due, while pre-buffering the
+        # stream has until then to come back
+        if self.due:
+            if self.retries >= stream_retries:
+                log('giving up on the alarm')
+                self.stop()
+                return
+            self.retries += 1
+        log('retrying the stream in %d seconds' % stream_retry_delay)
+        if self.player:
+            self.player.close()
+            self.player = None
+        self.fallback = False
+        self.stream_started = False
+        self.in_ad = False
+        for timer in (self.start_timer, self.ad_timer):
+            self.timers.cancel(timer)
+        self.retry_timer = self.timers.add(stream_retry_delay, self.handle_retry)
+
+    def handle_retry(self):
+        self.retry_timer = None
+        self.open_player(stream_url)
+
+    def update_volume(self):
+        audible = self.due and (self.fallback or (self.stream_started and not self.in_ad))
+        if self.player and audible != self.audible:
+            self.audible = audible
+            self.player.volume(100 if audible else 0)
+            if audible:
+                log('playing audibly')
+
+    def handle_due(self):
+        self.due = True
+        self.update_volume()
+
+    def handle_deadline(self):
+        if not self.stream_started:
+            log('stream did not start in time')
+            if self.can_fall_back():
+                self.play_fallback()
+
+    def handle_stream_started(self):
+        self.timers.cancel(self.start_timer)
+        self.timers.cancel(self.deadline_timer)
+        self.stream_started = True
+        self.update_volume()
+
+    def handle_ad_end(self):
+        self.in_ad = False
+        self.update_volume()
+
+    def handle_player(self, msg):
+        if msg is None:
+            log('player exited')
+            self.player = None
+            if self.alarm:
+                self.handle_failure()
+            else:
+                self.stop()
+        elif msg.startswith('@S'):
+            # stream info is sent once mpg123 is decoding, but the metadata
+            # saying whether it's an advertisement follows a little later
+            self.start_timer = self.timers.add(meta_wait, self.handle_stream_started)
+        elif msg.startswith('@I ICY-META:'):
+            self.timers.cancel(self.ad_timer)
+            self.in_ad = "adw_ad='true'" in msg or "insertionType='preroll'" in msg
+            if self.in_ad:
+                duration = re.search(r"durationMilliseconds='(\d+)'", msg)
+                seconds = int(duration.group(1)) / 1000.0 if duration else ad_timeout
+                log('advertisement for %.0f seconds' % seconds)
+                self.ad_timer = self.timers.add(seconds, self.handle_ad_end)
+            if not self.stream_started:
+                self.handle_stream_started()
+            else:
+                self.update_volume()
+        elif msg.startswith('@P 0'):
+            # playback ended, loop the fallback or fall back from the stream
+            if self.fallback and not self.fallback_failed:
+                self.player.load(fallback_file)
+            elif self.alarm:
+                self.handle_failure()
+            else:
+                self.stop()
+        elif msg.startswith('@E'):
+            # mpg123 follows an error with @P 0, which decides what's next
+            log('player error: %s' % msg[3:])
+            if self.fallback:
+                self.fallback_failed = True
+            elif self.alarm and not self.stream_started:
+                self.handle_failure()
+
+    def stop(self):
+        for timer in (self.due_timer, self.deadline_timer, self.start_timer, self.stop_timer,
+                      self.ad_timer, self.retry_timer):
+            self.timers.cancel(timer)
+        self.retry_timer = None
+        if self.player:
+            log('stopping')
+            self.player.close()
+            self.player = None
+        if self.muted:
+            self.mute(False)
+        self.alarm = False
+
+    def mute(self, muted):
+        if muted != self.muted:
+            set_mute(muted)
+            self.muted = muted
+
+    def handle_button(self):
+        if self.retry_timer:
+            self.stop()
+        elif self.player and not (self.alarm and not self.due):
+            self.stop()
+        elif self.player:
+            # pressed while pre-buffering, sound the alarm now
+            self.handle_due()
         else:
-            pid = str(os.getpid())
-            with open(pid_file, 'w') as fout:
-                fout.write(pid)
-
-        # daemon setup
-        signal.signal(signal.SIGUSR1, handle_signal)
-        button = gpiozero.Button(26)
-        button.when_pressed=handle_button
-        proc = None
-        start = 0.0
-
-        # daemon loop
+            self.start(alarm=False)
+
+    def handle_child(self):
+        if self.player and self.player.proc.poll() is not None:
+            self.player.close()
+            self.handle_player(None)
+
+    def handle_wakeup(self, fileobj):
         try:
-            while True:
-                if proc:
-                    if ((start > 0.0 and (time.time() - start) > 3600) or
-                        (not alarm and not play)):
-                        proc.terminate()
-                        proc = None
-                        alarm = False
-                        play = False
-                else:
-                    if alarm:
-                        # mute and wait 30 seconds in case the stream starts with an advertisement
-                        subprocess.call(["amixer", "set", "Headphone", "mute"])
-                        proc = subprocess.Popen(["mpg123", "http://cms.stream.publicradio.org/cms.mp3"])
-                        start = time.time()
-                        time.sleep(30)
-                        subprocess.call(["amixer", "set", "Headphone", "unmute"])
-                    elif play:
-                        proc = subprocess.Popen(["mpg123", "http://cms.stream.publicradio.org/cms.mp3"])
-                        start = 0.0
-                time.sleep(1)
-        except:
-            os.unlink(pid_file)
-            return 1
+            while os.read(self.wakeup_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+        events, self.events = self.events, []
+        for event in events:
+            if event == 'alarm':
+                self.start(alarm=True)
+            elif event == 'button':
+                self.handle_button()
+            elif event == 'child':
+                self.handle_child()
+            elif event == 'quit':
+                self.running = False
+
+    def handle_accept(self, fileobj):
+        conn, addr = self.control.accept()
+        conn.settimeout(1.0)
+        try:
+            request = conn.recv(1024).decode('utf-8').split()
+            reply = self.command(request)
+            conn.sendall((reply + '\n').encode('utf-8'))
+        except (OSError, UnicodeDecodeError) as e:
+            log('control socket error: %s' % e)
+        finally:
+            conn.close()
 
-    # alarm called from cron
-    else:
-        if pid:
-            os.kill(int(pid), signal.SIGUSR1)
+    def command(self, args):
+        if not args:
+            return 'error: empty command'
+        cmd = args[0]
+        if cmd == 'alarm':
+            self.start(alarm=True)
+        elif cmd == 'play':
+            self.start(alarm=False)
+        elif cmd == 'stop':
+            self.stop()
+        elif cmd == 'mute':
+            self.mute(True)
+        elif cmd == 'unmute':
+            self.mute(False)
+        elif cmd == 'add' and len(args) in (2, 3):
+            try:
+                entry = make_entry(args[1], args[2].split(',') if len(args) == 3 else None)
+            except ValueError:
+                return 'error: expected HH:MM [days]'
+            self.schedule = [e for e in self.schedule if e['time'] != entry['time']]
+            self.schedule.append(entry)
+            self.save_schedule()
+            self.arm_schedule()
+        elif cmd == 'remove' and len(args) == 2:
+            try:
+                when = make_entry(args[1])['time']
+            except ValueError:
+                return 'error: expected HH:MM'
+            self.schedule = [e for e in self.schedule if e['time'] != when]
+            self.save_schedule()
+            self.arm_schedule()
+        elif cmd == 'list':
+            return json.dumps(self.schedule)
+        elif cmd == 'status':
+            pass
         else:
-            # the daemon is not running so run a standalone alarm instance
-            button = gpiozero.Button(26)
+            return 'error: unknown command %s' % ' '.join(args)
+        return self.status()
 
-            # mute and wait 30 seconds in case the stream starts with an advertisement
-            subprocess.call(["amixer", "set", "Headphone", "mute"])
-            proc = subprocess.Popen(["mpg123", "http://cms.stream.publicradio.org/cms.mp3"])
-            start = time.time()
-            time.sleep(30)
-            subprocess.call(["amixer", "set", "Headphone", "unmute"])
+    def status(self):
+        if self.retry_timer:
+            state = 'alarm retrying'
+        elif not self.player:
+            state = 'idle'
+        elif self.alarm and not self.due:
+            state = 'buffering'
+        else:
+            state = 'alarm' if self.alarm else 'playing'
+            if self.fallback:
+                state += ' fallback'
+            elif not self.audible:
+                state += ' waiting'
+        return '%s%s' % (state, ' muted' if self.muted else '')
+
+    def run(self, once=False):
+        ''' run the event loop, with once it returns when playback stops '''
+        while self.running:
+            for key, mask in self.selector.select(self.timers.timeout()):
+                key.data(key.fileobj)
+            self.timers.run_due()
+            if once and not self.player and not self.retry_timer:
+                break
+        self.stop()
+
+def send_command(args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5.0)
+    sock.connect(control_socket)
+    try:
+        sock.sendall(' '.join(args).encode('utf-8'))
+        return sock.recv(4096).decode('utf-8').strip()
+    finally:
+        sock.close()
 
-            # wait 1 hour for button press
-            button.wait_for_press(3600)
+def main(args):
+    if 'daemon' in args:
+        try:
+            reply = send_command(['status'])
+        except OSError:
+            reply = None
+        if reply:
+            print('alarm daemon is already running (%s)' % reply)
+            return 1
+        with open(pid_file, 'w') as fout:
+            fout.write(str(os.getpid()))
 
-            # stop stream
-            proc.terminate()
+        daemon = AlarmDaemon()
+        daemon.setup_signals()
+        daemon.setup_button()
+        daemon.setup_control()
+        daemon.load_schedule()
+        log('alarm daemon started, %d alarms scheduled' % len(daemon.schedule))
+        try:
+            daemon.run()
+        finally:
+            os.unlink(pid_file)
+            os.unlink(control_socket)
+        return 0
 
+    command = args[1:] or ['alarm']
+    try:
+        print(send_command(command))
+    except OSError:
+        if command != ['alarm']:
+            print('alarm daemon is not running')
+            return 1
+        # the daemon is not running so run a standalone alarm instance
+        daemon = AlarmDaemon()
+        daemon.setup_signals()
+        daemon.setup_button()
+        daemon.start(alarm=True)
+        daemon.run(once=True)
     return 0
 
 if __name__ == '__main__':
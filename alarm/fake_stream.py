@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# local stand-in for the radio stream so the alarm can be tested offline
+#
+# Serves an mp3 file in a loop, paced at its bitrate, as an icecast style
+# stream with ICY metadata. Like the real stream it starts with a preroll
+# advertisement in the metadata. --delay holds back the first byte to
+# simulate a slow stream and --fail drops every connection.
+#
+# example:
+#     ./fake_stream.py /home/pi/alarm.mp3 --ad 16 --delay 5 &
+#     then set stream_url in alarm.py to http://localhost:8000/cms.mp3
+
+import argparse
+import http.server
+import sys
+import time
+
+metaint = 16000 # bytes of audio between metadata blocks
+
+def icy_block(text):
+    data = text.encode('utf-8')
+    blocks = (len(data) + 15) // 16
+    return bytes([blocks]) + data.ljust(blocks * 16, b'\0')
+
+def make_handler(args, audio):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, fmt, *fmt_args):
+            sys.stderr.write('%s\n' % (fmt % fmt_args))
+
+        def do_GET(self):
+            if args.fail:
+                self.close_connection = True
+                return
+            time.sleep(args.delay)
+            use_meta = self.headers.get('Icy-MetaData') == '1'
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('icy-name', 'Fake Public Radio')
+            if use_meta:
+                self.send_header('icy-metaint', str(metaint))
+            self.end_headers()
+
+            bytes_per_second = args.bitrate * 1000 // 8
+            ad_bytes = args.ad * bytes_per_second
+            ad = ("StreamTitle='';StreamUrl='';adw_ad='true';durationMilliseconds='%d';"
+                  "insertionType='preroll';" % (args.ad * 1000))
+            title = "StreamTitle='Good Night and Good Rest - John Johnson';StreamUrl='';"
+            start = time.monotonic()
+            sent = 0
+            pos = 0
+            try:
+                while True:
+                    chunk = audio[pos:pos + metaint]
+                    if len(chunk) < metaint:
+                        chunk += audio[:metaint - len(chunk)]
+                    pos = (pos + metaint) % len(audio)
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if use_meta:
+                        if sent <= metaint:
+                            self.wfile.write(icy_block(ad if args.ad else title))
+                        elif sent - metaint < ad_bytes <= sent:
+                            self.wfile.write(icy_block(title))
+                        else:
+                            self.wfile.write(b'\0')
+                    self.wfile.flush()
+                    # pace the stream like a live broadcast
+                    ahead = sent / bytes_per_second - (time.monotonic() - start)
+                    if ahead > 1.0:
+                        time.sleep(ahead - 1.0)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+    return Handler
+
+def main(args):
+    parser = argparse.ArgumentParser(description='fake icy radio stream')
+    parser.add_argument('file', help='mp3 file to stream in a loop')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--bitrate', type=int, default=128, help='kbps to pace the stream at')
+    parser.add_argument('--ad', type=int, default=16, help='seconds of preroll advertisement, 0 for none')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before the stream starts')
+    parser.add_argument('--fail', action='store_true', help='drop every connection')
+    args = parser.parse_args(args[1:])
+
+    with open(args.file, 'rb') as fin:
+        audio = fin.read()
+    server = http.server.ThreadingHTTPServer(('', args.port), make_handler(args, audio))
+    print('streaming %s on port %d' % (args.file, args.port))
+    server.serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
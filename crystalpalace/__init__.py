@@ -0,0 +1,9 @@
+# shared core of the crystalpalace thermostats
+#
+#   hal       clocks, relays and sensor hardware, real or simulated
+#   fusion    vectorized fusion of all temperature sensors
+#   sensors   temperature and humidity sensor backends
+#   store     persistent state
+#   rest      /state, /button and /command api
+#   feed      zmq state feed for the hub
+#   control   control engine and the strategies for each kind of controller
@@ -0,0 +1,443 @@
+# control engine shared by every controller in the house
+#
+# A Controller owns the state, sensors, fusion and relays and runs the main
+# loop. What it does with the relays is up to its strategy:
+#
+#   HvacStrategy        furnace with heat, ac and fan relays
+#   MillivoltStrategy   millivolt gas fireplace, heat only, on a timer
+
+import collections
+import copy
+import datetime
+import math
+import numbers
+import threading
+
+from crystalpalace import fusion
+from crystalpalace import hal
+from crystalpalace import sensors
+from crystalpalace import store
+
+margin = 0.5 # degrees f
+sample_count = 3 # number of previous samples to average
+poll_rate = 5 # seconds
+timeout = 60 # seconds
+loop_rate = 5 # seconds
+startup_delay = 30 # seconds of data to accumulate before controlling
+save_rate = 300 # seconds between persisting the state
+command_keys = 256 # idempotency keys remembered for retried commands
+set_temp_range = (40, 90) # degrees f accepted from commands
+
+class CommandError(Exception):
+    ''' a command that was rejected, status is the http status to answer with '''
+    def __init__(self, status, message, state=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.state = state
+
+class DutyCycle:
+    ''' percentage of loop iterations spent running over a sliding window '''
+    def __init__(self, window=24*60*60):
+        self.window = window
+        self.samples = collections.deque()
+        self.total = 0
+
+    def add(self, now, value):
+        self.samples.append((now, value))
+        self.total += value
+        while self.samples[0][0] < (now - self.window):
+            self.total -= self.samples.popleft()[1]
+        return round(100.0 * self.total / len(self.samples))
+
+class HvacStrategy:
+    ''' forced air furnace with air conditioning '''
+    relays = { 'heat' : 22, 'fan' : 23, 'ac' : 24 }
+    heating_relays = ('heat', 'ac') # turned off when there is no data
+    state_defaults = {
+        'status' : 'off',
+        'mode' : 'heat',
+        'fan' : 'auto',
+        'set_temp' : 68,
+        'cur_temp' : 72,
+        'duty_cycle' : 0,
+        'current_run_time' : 0,
+        'last_run_time' : 0,
+        'sensors' : {},
+    }
+
+    def setup(self, ctl):
+        self.duty_cycle = DutyCycle()
+        self.run_time_start = None
+
+    def press(self, ctl, button):
+        if button == 'auto' or button == 'on':
+            ctl.state['fan'] = button
+        elif button == 'cool' or button == 'heat' or button == 'off':
+            ctl.state['mode'] = button
+        else:
+            return False
+        return True
+
+    def validate(self, ctl, name, value):
+        ''' return the setting to apply for one command operation, raise ValueError if invalid '''
+        if name == 'mode' and value in ('cool', 'heat', 'off'):
+            return value
+        if name == 'fan' and value in ('auto', 'on'):
+            return value
+        raise ValueError('invalid %s: %r' % (name, value))
+
+    def apply(self, ctl, name, value):
+        ctl.state[name] = value
+
+    def control(self, ctl, now, average):
+        state = ctl.state
+        logger = ctl.logger
+        heat = ctl.relays['heat']
+        fan = ctl.relays['fan']
+        ac = ctl.relays['ac']
+
+        # turn heat/ac on/off based on temperature and margin
+        if state['mode'] == 'heat':
+            if ac.value > 0:
+                logger.info('turning ac off')
+                ac.off()
+            if heat.value > 0 and average > state['set_temp'] + ctl.margin:
+                logger.info('turning heat off (%.1f F)' % average)
+                heat.off()
+            elif heat.value < 1 and average < state['set_temp'] - ctl.margin:
+                logger.info('turning heat on (%.1f F)' % average)
+                heat.on()
+        elif state['mode'] == 'cool':
+            if heat.value > 0:
+                logger.info('turning heat off')
+                heat.off()
+            if ac.value > 0 and average < state['set_temp'] - ctl.margin:
+                logger.info('turning ac off (%.1f F)' % average)
+                ac.off()
+            elif ac.value < 1 and average > state['set_temp'] + ctl.margin:
+                logger.info('turning ac on (%.1f F)' % average)
+                ac.on()
+        else: # mode == off
+            if heat.value > 0:
+                logger.info('turning heat off')
+                heat.off()
+            if ac.value > 0:
+                logger.info('turning ac off')
+                ac.off()
+
+        # handle fan
+        if fan.value > 0 and state['fan'] == 'auto':
+            logger.info('turning fan off')
+            fan.off()
+        elif fan.value < 1 and state['fan'] == 'on':
+            logger.info('turning fan on')
+            fan.on()
+
+        # set status
+        if heat.value > 0:
+            state['status'] = 'heating'
+        elif ac.value > 0:
+            state['status'] = 'cooling'
+        elif fan.value > 0:
+            state['status'] = 'fan'
+        else:
+            state['status'] = 'off'
+
+        # calculate duty cycle and run times
+        if state['status'] in ('heating', 'cooling'):
+            state['duty_cycle'] = self.duty_cycle.add(now, 1)
+            if self.run_time_start:
+                state['current_run_time'] = round((now - self.run_time_start) / 60.0)
+            else:
+                self.run_time_start = now
+        else:
+            state['duty_cycle'] = self.duty_cycle.add(now, 0)
+            if self.run_time_start:
+                self.run_time_start = None
+                state['last_run_time'] = state['current_run_time']
+                state['current_run_time'] = 0
+
+class MillivoltStrategy:
+    ''' millivolt gas fireplace that heats for an hour at a time '''
+    relays = { 'heat' : 24 }
+    heating_relays = ('heat',)
+    state_defaults = {
+        'status' : 'off',
+        'mode' : 'off',
+        'set_temp' : 68,
+        'cur_temp' : 72,
+        'heat_until' : 0,
+        'sensors' : {},
+    }
+    run_time = 3600 # seconds added by plus_one_hour
+    max_run_time = 12*60*60 # furthest heat_until accepted from commands
+
+    def setup(self, ctl):
+        self.set_off_time(ctl, ctl.clock.time())
+
+    def set_off_time(self, ctl, off_time):
+        if off_time > ctl.clock.time():
+            off_time_str = datetime.datetime.fromtimestamp(off_time).strftime('%H:%M')
+            mode = 'Heating until %s' % off_time_str
+        else:
+            mode = 'off'
+        self.off_time = off_time
+        ctl.state['heat_until'] = off_time
+        ctl.state['mode'] = mode
+
+    def press(self, ctl, button):
+        now = ctl.clock.time()
+        if button == 'off':
+            self.set_off_time(ctl, now)
+        elif button == 'plus_one_hour':
+            self.set_off_time(ctl, max(now, self.off_time) + self.run_time)
+        else:
+            return False
+        return True
+
+    def validate(self, ctl, name, value):
+        ''' return the setting to apply for one command operation, raise ValueError if invalid '''
+        if name == 'mode' and value == 'off':
+            return value
+        if name == 'heat_until' and isinstance(value, numbers.Real) and not isinstance(value, bool) \
+           and math.isfinite(value):
+            now = ctl.clock.time()
+            # a time already past just turns the fireplace off
+            if value <= now + self.max_run_time:
+                return max(float(value), now)
+        raise ValueError('invalid %s: %r' % (name, value))
+
+    def apply(self, ctl, name, value):
+        if name == 'mode':
+            self.set_off_time(ctl, ctl.clock.time())
+        else:
+            self.set_off_time(ctl, value)
+
+    def control(self, ctl, now, average):
+        state = ctl.state
+        logger = ctl.logger
+        heat = ctl.relays['heat']
+
+        # set mode off when time runs out
+        if state['mode'] != 'off' and now > self.off_time:
+            logger.info('setting mode off because time expired')
+            state['mode'] = 'off'
+
+        # turn heat on/off based on temperature and margin
+        if state['mode'] == 'off':
+            if heat.value > 0:
+                logger.info('turning heat off')
+                heat.off()
+        else:
+            if heat.value > 0 and average > state['set_temp'] + ctl.margin:
+                logger.info('turning heat off (%.1f F)' % average)
+                heat.off()
+            elif heat.value < 1 and average < state['set_temp'] - ctl.margin:
+                logger.info('turning heat on (%.1f F)' % average)
+                heat.on()
+
+        # set status
+        if heat.value > 0:
+            state['status'] = 'heating'
+        else:
+            state['status'] = 'off'
+
+class Controller:
+    ''' state, sensors and relays of one controller and its main loop '''
+    def __init__(self, strategy, state_file, logger, clock=None, Relay=hal.GpioRelay,
+                 zmq_address='tcp://%s.local:5555'):
+        self.strategy = strategy
+        self.state_file = state_file
+        self.logger = logger
+        self.clock = clock or hal.Clock()
+        self.Relay = Relay
+        self.zmq_address = zmq_address
+        self.margin = margin
+        self.poll_rate = poll_rate
+        self.timeout = timeout
+        self.state = store.load(state_file, strategy.state_defaults, logger)
+        self.state.setdefault('sensors', {})
+        self.sensors = {}
+        self.humidity_sensors = {}
+        self.fusion = fusion.SensorFusion(sample_count)
+        self.relays = {}
+        self.subscriber = None
+        self.subscriber_lock = threading.Lock()
+        self.feed = None # feed.StateFeed, set to publish the state to the hub
+        # serializes user changes against each other and the control loop
+        self.lock = threading.Lock()
+        self.state.setdefault('version', 0)
+        self.commands = collections.OrderedDict()
+        self.strategy.setup(self)
+
+    def add_sensor(self, sensor):
+        self.sensors[sensor.name] = sensor
+        return sensor
+
+    def add_humidity_sensor(self, sensor):
+        self.humidity_sensors[sensor.name] = sensor
+        return sensor
+
+    def zmq_subscriber(self):
+        ''' the zmq subscriber shared by all remote sensors, started on first use '''
+        with self.subscriber_lock:
+            if self.subscriber is None:
+                self.subscriber = sensors.ZMQSubscriber(self)
+            return self.subscriber
+
+    def set_use_for_control(self, name, value):
+        self.sensors[name].use_for_control = value
+        self.state['sensors'][name]['use_for_control'] = value
+
+    def publish(self):
+        if self.feed:
+            self.feed.publish()
+
+    def press(self, button):
+        ''' handle a button from the ui, return False if it is unknown '''
+        with self.lock:
+            state = self.state
+            if button == 'up':
+                state['set_temp'] = min(state['set_temp'] + 1, set_temp_range[1])
+            elif button == 'down':
+                state['set_temp'] = max(state['set_temp'] - 1, set_temp_range[0])
+            elif button in self.sensors:
+                self.set_use_for_control(button, not self.sensors[button].use_for_control)
+            elif not self.strategy.press(self, button):
+                self.logger.warning('user pressed unknown button: %s' % button)
+                return False
+            state['version'] += 1
+        self.logger.info('user pressed button: %s' % button)
+        self.publish()
+        return True
+
+    def validate(self, ops):
+        ''' check every operation of a command, return them as (name, value) pairs '''
+        if not isinstance(ops, dict):
+            raise ValueError('ops must be an object')
+        settings = []
+        for name, value in ops.items():
+            if name == 'set_temp':
+                if not isinstance(value, numbers.Real) or isinstance(value, bool) \
+                   or not math.isfinite(value) \
+                   or not set_temp_range[0] <= value <= set_temp_range[1]:
+                    raise ValueError('invalid set_temp: %r' % (value,))
+                settings.append((name, value))
+            elif name == 'sensors':
+                if not isinstance(value, dict):
+                    raise ValueError('sensors must be an object')
+                for sensor, sensor_ops in value.items():
+                    if sensor not in self.sensors:
+                        raise ValueError('unknown sensor: %s' % sensor)
+                    if not isinstance(sensor_ops, dict) or set(sensor_ops) != { 'use_for_control' } \
+                       or not isinstance(sensor_ops['use_for_control'], bool):
+                        raise ValueError('invalid settings for sensor %s' % sensor)
+                    settings.append((name, (sensor, sensor_ops['use_for_control'])))
+            else:
+                settings.append((name, self.strategy.validate(self, name, value)))
+        # an empty command would use up a version and make everyone else's
+        # next command fail
+        if not settings:
+            raise ValueError('no operations')
+        return settings
+
+    def command(self, ops, expected_version=None, key=None):
+        '''
+        apply a batch of absolute settings from the ui as one change
+
+        Every operation is range checked before any is applied and the
+        result is persisted with a single write. expected_version makes the
+        command conditional on nobody else having changed the settings since
+        the client last saw them. A retry carrying the key of a command that was
+        already applied gets the original answer instead of applying it twice.
+        Raises CommandError if the command is rejected.
+        '''
+        if key is not None and not isinstance(key, str):
+            raise CommandError(400, 'idempotency key must be a string')
+        if expected_version is not None and (not isinstance(expected_version, int)
+                                             or isinstance(expected_version, bool)):
+            raise CommandError(400, 'expected version must be an integer')
+        with self.lock:
+            if key is not None and key in self.commands:
+                return self.commands[key]
+            if expected_version is not None and expected_version != self.state['version']:
+                raise CommandError(409, 'version is %d, expected %s' % (self.state['version'], expected_version),
+                                   copy.deepcopy(self.state))
+            try:
+                settings = self.validate(ops)
+            except ValueError as e:
+                raise CommandError(400, str(e))
+            for name, value in settings:
+                if name == 'set_temp':
+                    self.state['set_temp'] = value
+                elif name == 'sensors':
+                    self.set_use_for_control(*value)
+                else:
+                    self.strategy.apply(self, name, value)
+            self.state['version'] += 1
+            store.save(self.state_file, self.state)
+            result = copy.deepcopy(self.state)
+            if key is not None:
+                self.commands[key] = result
+                if len(self.commands) > command_keys:
+                    self.commands.popitem(last=False)
+        self.logger.info('user sent command: %s' % ops)
+        self.publish()
+        return result
+
+    def fuse(self, now):
+        ''' fuse all sensors, update their state and return the house average '''
+        state = self.state
+        house_average, stale = self.fusion.aggregate(now, self.timeout)
+        for name in stale:
+            state['sensors'][name]['temperature'] = None
+            self.logger.warning('%s: stale data' % name)
+        # only sensors whose values changed are written to the state
+        for name, average, outlier in self.fusion.changes():
+            sensor_state = state['sensors'][name]
+            sensor_state['average'] = average
+            if outlier and not sensor_state.get('outlier'):
+                self.logger.warning('%s: rejected as outlier (%.1f F)' % (name, average))
+            sensor_state['outlier'] = outlier
+        for name in list(self.humidity_sensors):
+            if self.humidity_sensors[name].last_sample < (now - self.timeout):
+                state['sensors'][name]['humidity'] = None
+        return house_average
+
+    def run(self):
+        state = self.state
+        logger = self.logger
+        clock = self.clock
+
+        # set up control lines
+        for name, pin in self.strategy.relays.items():
+            self.relays[name] = self.Relay(pin)
+            self.relays[name].off()
+
+        logger.info('waiting for data to accumulate')
+        clock.sleep(startup_delay)
+        logger.info('starting main control loop')
+        last_save = clock.time()
+        while True:
+            clock.sleep(loop_rate)
+            now = clock.time()
+
+            house_average = self.fuse(now)
+
+            with self.lock:
+                # turn heat/ac off if no temperature data is available
+                if house_average is None:
+                    for name in self.strategy.heating_relays:
+                        if self.relays[name].value > 0:
+                            logger.warning('turning %s off due to lack of data' % name)
+                            self.relays[name].off()
+                    state['status'] = 'error'
+                else:
+                    state['cur_temp'] = round(house_average)
+                    self.strategy.control(self, now, house_average)
+
+                    # persist the current settings every 5 minutes
+                    if now > last_save + save_rate:
+                        last_save = now
+                        store.save(self.state_file, state)
+            self.publish()
@@ -0,0 +1,49 @@
+# zmq state feed for the hub
+#
+# Every controller publishes its whole state as json on a pub socket each
+# time through the control loop and right after every user change. The hub
+# subscribes once and zmq keeps the connection up and reconnects on its own,
+# so watching a controller costs it one message per loop no matter how many
+# dashboards are open.
+#
+# The feed is advertised over mdns (avahi, which already resolves the .local
+# names in the house) as a service_type service named after the controller,
+# with the port of its rest api in the txt record, so the hub finds every
+# controller without a list of them.
+
+import atexit
+import json
+import socket
+import subprocess
+import threading
+
+feed_port = 5556
+service_type = '_crystalpalace._tcp'
+
+def advertise(name, port, rest_port=None):
+    ''' advertise a state feed until this process exits, return the avahi-publish process '''
+    cmd = ['avahi-publish', '-s', name, service_type, str(port)]
+    if rest_port:
+        cmd.append('rest=%d' % rest_port)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(proc.terminate)
+    return proc
+
+class StateFeed:
+    def __init__(self, ctl, port=feed_port, rest_port=None):
+        import zmq
+        self.ctl = ctl
+        self.sock = zmq.Context.instance().socket(zmq.PUB)
+        self.sock.bind('tcp://*:%d' % port)
+        # zmq sockets are not thread safe, user changes publish from flask threads
+        self.lock = threading.Lock()
+        try:
+            self.publisher = advertise(socket.gethostname(), port, rest_port)
+        except OSError as e:
+            self.publisher = None
+            ctl.logger.warning('not advertising the state feed, avahi-publish failed: %s' % e)
+
+    def publish(self):
+        message = json.dumps(self.ctl.state)
+        with self.lock:
+            self.sock.send_string(message)
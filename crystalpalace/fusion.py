@@ -0,0 +1,209 @@
+# vectorized fusion of all temperature sensors into one house temperature
+#
+# Every sensor owns one row of a sensors x samples array that is used as a
+# ring buffer of its most recent samples, and its mean is updated as each
+# sample arrives. Each control loop aggregates all rows at once: stale rows
+# are cleared and sensors whose mean is far from the median of the others
+# (measured in median absolute deviations) are left out of the weighted house
+# average, so one failing probe can't swing the furnace.
+#
+# The control loop runs every few seconds with cold caches, where each numpy
+# call costs several microseconds no matter how small its array is. So
+# everything that only concerns one sensor is kept up to date as it changes
+# instead of being recomputed for every sensor on every loop, and the outlier
+# rejection runs in plain python for a house's worth of sensors and as a
+# fixed handful of numpy calls beyond that.
+
+import threading
+
+import numpy as np
+
+mad_scale = 1.4826 # makes the mad comparable to a standard deviation
+mad_limit = 3.5 # reject sensors further than this many scaled mads
+mad_floor = 5.0 # degrees f, rooms legitimately differ by this much
+small_count = 32 # up to this many sensors plain python beats numpy
+
+def median(values):
+    # np.median has a lot of overhead for the few sensors in a house
+    values = sorted(values) if isinstance(values, list) else np.sort(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return float(values[mid])
+    return float(values[mid - 1] + values[mid]) / 2.0
+
+def robust_average(means, weights):
+    '''
+    return the weighted average of means leaving out the outliers (None if
+    no sensor is left) and the indexes of the outliers
+
+    means and weights are lists for a few sensors and arrays for more, a
+    weight of 0 leaves a sensor out.
+    '''
+    if isinstance(means, list):
+        rows = [i for i, weight in enumerate(weights) if weight]
+        means = [means[i] for i in rows]
+        weights = [weights[i] for i in rows]
+        outliers = []
+        if len(rows) >= 3:
+            center = median(means)
+            deviation = [abs(mean - center) for mean in means]
+            limit = max(mad_limit * mad_scale * median(deviation), mad_floor)
+            outliers = [i for i, d in enumerate(deviation) if d > limit]
+            for i in outliers:
+                weights[i] = 0.0
+        total = sum(weights)
+        dot = sum(weight * mean for weight, mean in zip(weights, means))
+    else:
+        rows = np.flatnonzero(weights)
+        means = means[rows]
+        weights = weights[rows]
+        outliers = []
+        if len(rows) >= 3:
+            deviation = np.abs(means - median(means))
+            limit = max(mad_limit * mad_scale * median(deviation), mad_floor)
+            rejected = deviation > limit
+            if rejected.any():
+                outliers = np.flatnonzero(rejected).tolist()
+                weights = np.where(rejected, 0.0, weights)
+        total = weights.sum()
+        dot = np.dot(weights, means)
+    average = float(dot / total) if total > 0 else None
+    return average, [int(rows[i]) for i in outliers]
+
+class SensorFusion:
+    ''' ring buffers and aggregates for every sensor in the house '''
+    def __init__(self, sample_count, capacity=8):
+        self.sample_count = sample_count
+        self.lock = threading.Lock()
+        self.names = []
+        self.samples = np.full((capacity, sample_count), np.nan)
+        self.pos = np.zeros(capacity, dtype=np.intp)
+        self.last_sample = np.zeros(capacity)
+        self.weights = np.ones(capacity)
+        self.use_for_control = np.zeros(capacity, dtype=bool)
+        self.means = np.full(capacity, np.nan)
+        self.outliers = np.zeros(capacity, dtype=bool)
+        # weight of each sensor in the house average, 0 while it has no data
+        # or isn't used for control
+        self.active = np.zeros(capacity)
+        self.outlier_rows = []
+        # rows whose mean or outlier flag may have changed since changes()
+        self.dirty = set()
+        self.reported = [] # (rounded mean, outlier) last returned by changes()
+
+    def add_sensor(self, name, now, weight=1.0, use_for_control=True):
+        ''' allocate a row for a sensor and return its index '''
+        with self.lock:
+            row = len(self.names)
+            if row == len(self.pos):
+                self.grow()
+            self.names.append(name)
+            self.last_sample[row] = now
+            self.weights[row] = weight
+            self.use_for_control[row] = use_for_control
+            self.reported.append(None) # always report new sensors once
+            self.dirty.add(row)
+            return row
+
+    def grow(self):
+        capacity = 2 * len(self.pos)
+        def extend(a, fill):
+            shape = (capacity - len(a),) + a.shape[1:]
+            return np.concatenate((a, np.full(shape, fill, dtype=a.dtype)))
+        self.samples = extend(self.samples, np.nan)
+        self.pos = extend(self.pos, 0)
+        self.last_sample = extend(self.last_sample, 0.0)
+        self.weights = extend(self.weights, 1.0)
+        self.use_for_control = extend(self.use_for_control, False)
+        self.means = extend(self.means, np.nan)
+        self.outliers = extend(self.outliers, False)
+        self.active = extend(self.active, 0.0)
+
+    def update_active(self, row):
+        has_data = self.means[row] == self.means[row] # not nan
+        if has_data and self.use_for_control[row]:
+            self.active[row] = self.weights[row]
+        else:
+            self.active[row] = 0.0
+
+    def set_use_for_control(self, row, value):
+        with self.lock:
+            self.use_for_control[row] = value
+            self.update_active(row)
+
+    def add_sample(self, row, sample, now):
+        with self.lock:
+            pos = int(self.pos[row])
+            samples = self.samples[row]
+            samples[pos] = sample
+            self.pos[row] = (pos + 1) % self.sample_count
+            self.last_sample[row] = now
+            values = [v for v in samples.tolist() if v == v] # skip nan
+            self.means[row] = sum(values) / len(values)
+            self.update_active(row)
+            self.dirty.add(row)
+
+    def aggregate(self, now, timeout):
+        '''
+        update the per-sensor means and outlier flags
+
+        Returns the weighted house average (None if no sensor can be used)
+        and the names of sensors whose data went stale.
+        '''
+        with self.lock:
+            n = len(self.names)
+            if n == 0:
+                return None, []
+
+            # check for stale data
+            cutoff = now - timeout
+            stale_rows = []
+            if self.last_sample[:n].min() < cutoff:
+                stale_rows = np.flatnonzero(self.last_sample[:n] < cutoff)
+                self.samples[stale_rows] = np.nan
+                self.pos[stale_rows] = 0
+                self.means[stale_rows] = np.nan
+                self.active[stale_rows] = 0.0
+                stale_rows = stale_rows.tolist()
+                self.dirty.update(stale_rows)
+
+            # clear last loop's outliers
+            if self.outlier_rows:
+                self.outliers[self.outlier_rows] = False
+                self.dirty.update(self.outlier_rows)
+                self.outlier_rows = []
+
+            # reject sensors far from the median of the usable ones
+            if n <= small_count:
+                average, outlier_rows = robust_average(self.means[:n].tolist(),
+                                                       self.active[:n].tolist())
+            else:
+                average, outlier_rows = robust_average(self.means[:n], self.active[:n])
+            if outlier_rows:
+                self.outlier_rows = outlier_rows
+                self.outliers[outlier_rows] = True
+                self.dirty.update(outlier_rows)
+            stale_names = [self.names[i] for i in stale_rows]
+        return average, stale_names
+
+    def changes(self):
+        '''
+        return (name, mean, outlier) for every sensor whose mean rounded to
+        0.1 or outlier flag changed since the last call, mean is None if the
+        sensor has no data
+        '''
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            if not dirty:
+                return []
+            n = len(self.names)
+            means = self.means[:n].round(1).tolist()
+            outliers = self.outliers[:n].tolist()
+            changed = []
+            for row in dirty:
+                mean = means[row]
+                value = (None if mean != mean else mean, outliers[row])
+                if value != self.reported[row]:
+                    self.reported[row] = value
+                    changed.append((self.names[row],) + value)
+            return changed
@@ -0,0 +1,388 @@
+# hardware abstraction layer so the thermostat can run off the pi
+
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+sysfs_root = '/sys'
+
+class Clock:
+    ''' wall clock used on the real hardware '''
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class SimulationComplete(Exception):
+    ''' raised in the driving thread when a SimClock reaches its end time '''
+    pass
+
+class SimClock:
+    '''
+    discrete event clock for simulation
+
+    The thread that creates the clock (the driver, usually the one that goes
+    on to run main()) owns time.
+    Sleeping in the driver advances time to the next wakeup of any other
+    clocked thread, releases the threads that are due and waits for them to
+    go back to sleep before advancing again. Other threads simply block until
+    time reaches their wakeup.
+    '''
+    def __init__(self, start=0.0, end=None, settle_timeout=1.0):
+        self.now = start
+        self.end = end
+        self.settle_timeout = settle_timeout
+        self.driver = threading.current_thread()
+        self.cond = threading.Condition()
+        self.waiters = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.local = threading.local()
+        self.advance_hooks = []
+        self.settle_hooks = []
+        self.busy_time = 0.0
+        self.busy_start = None
+        self.loops = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if threading.current_thread() is self.driver:
+            self.advance(seconds)
+        else:
+            self.wait(seconds)
+
+    def wait(self, seconds):
+        with self.cond:
+            if getattr(self.local, 'woken', False):
+                self.local.woken = False
+                self.running = max(0, self.running - 1)
+                if self.running == 0:
+                    self.cond.notify()
+            entry = (self.now + seconds, next(self.seq), threading.Event())
+            heapq.heappush(self.waiters, entry)
+        # each sleeper gets its own event so waking one doesn't wake them all
+        entry[2].wait()
+        self.local.woken = True
+
+    def advance(self, seconds):
+        # account the real time the driver spent since its last sleep
+        if self.busy_start is not None:
+            self.busy_time += time.perf_counter() - self.busy_start
+            self.loops += 1
+        target = self.now + seconds
+        while True:
+            with self.cond:
+                step_to = target
+                if self.waiters and self.waiters[0][0] < step_to:
+                    step_to = self.waiters[0][0]
+                if self.end is not None and step_to > self.end:
+                    raise SimulationComplete()
+                dt = step_to - self.now
+                self.now = step_to
+            for hook in self.advance_hooks:
+                hook(self.now, dt)
+            with self.cond:
+                while self.waiters and self.waiters[0][0] <= self.now:
+                    entry = heapq.heappop(self.waiters)
+                    self.running += 1
+                    entry[2].set()
+                deadline = time.monotonic() + self.settle_timeout
+                while self.running > 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # a woken thread blocked on something other than
+                        # the clock; stop waiting for it
+                        self.running = 0
+                        break
+                    self.cond.wait(remaining)
+            for hook in self.settle_hooks:
+                hook(self.now)
+            if self.now >= target:
+                break
+        self.busy_start = time.perf_counter()
+
+class GpioRelay:
+    ''' active low relay on a raspberry pi gpio pin '''
+    def __init__(self, pin):
+        import gpiozero
+        self.device = gpiozero.OutputDevice(pin, active_high=False)
+
+    @property
+    def value(self):
+        return self.device.value
+
+    def on(self):
+        self.device.on()
+
+    def off(self):
+        self.device.off()
+
+class SimRelay:
+    ''' relay that only records its state and when it changed '''
+    def __init__(self, pin, clock=None):
+        self.pin = pin
+        self.clock = clock or Clock()
+        self.value = 0
+        self.history = [(self.clock.time(), 0)]
+
+    def on(self):
+        self.set(1)
+
+    def off(self):
+        self.set(0)
+
+    def set(self, value):
+        if value != self.value:
+            self.value = value
+            self.history.append((self.clock.time(), value))
+
+    def on_time(self, start, end):
+        ''' seconds spent on between start and end '''
+        total = 0.0
+        points = self.history + [(end, self.value)]
+        for (t0, v), (t1, _) in zip(points, points[1:]):
+            t0 = max(t0, start)
+            t1 = min(t1, end)
+            if v and t1 > t0:
+                total += t1 - t0
+        return total
+
+def w1_slave_path(address):
+    return '%s/devices/w1_bus_master1/%s/w1_slave' % (sysfs_root, address)
+
+def read_w1_slave(address):
+    ''' return the temperature in c from a ds18b20, raise IOError on crc or format errors '''
+    reading_valid = False
+    temperature = None
+    with open(w1_slave_path(address)) as fin:
+        for line in fin:
+            if 'YES' in line:
+                reading_valid = True
+            if 't=' in line:
+                try:
+                    temperature = float(line.split('t=')[1].strip()) / 1000.0
+                except ValueError:
+                    raise IOError('invalid temperature in %s' % line.strip())
+    if not reading_valid or temperature is None:
+        raise IOError('crc check failed')
+    return temperature
+
+def find_w1_slave(clock):
+    ''' wait for a ds18b20 to show up on the 1-wire bus and return its address '''
+    while True:
+        try:
+            addresses = sorted(d for d in os.listdir('%s/devices/w1_bus_master1' % sysfs_root)
+                               if d.startswith('28-'))
+        except FileNotFoundError:
+            addresses = []
+        if addresses:
+            return addresses[0]
+        clock.sleep(1)
+
+class RHT03:
+    '''
+    rht03 temperature and humidity sensor through the rht03 kernel module
+
+    Every read of /dev/rht03 runs a full transaction on the sensor, which
+    needs about 2 seconds between conversions. Readers are serialized, the
+    hardware is touched at most once per min_interval and the last valid
+    reading is cached, so any number of consumers can call read() at will.
+    Checksum and timing failures are retried with exponential backoff.
+    '''
+    min_interval = 2.0 # seconds between conversions
+
+    def __init__(self, dev='/dev/rht03', clock=None, retries=3, backoff=1.0):
+        self.dev = dev
+        self.clock = clock or Clock()
+        self.retries = retries
+        self.backoff = backoff # seconds added to min_interval after the first failure
+        self.lock = threading.Lock()
+        self.last_transaction = None
+        self.last = None # (timestamp, temperature c, relative humidity)
+
+    def transaction(self):
+        fd = os.open(self.dev, os.O_RDONLY)
+        try:
+            data = os.read(fd, 32)
+            # the driver returns end of file once after each good reading
+            os.read(fd, 32)
+        finally:
+            os.close(fd)
+        values = dict(field.split(b'=') for field in data.split(b'\0')[0].split())
+        # both values are reported in tenths
+        return int(values[b't']) / 10.0, int(values[b'h']) / 10.0
+
+    def read(self, max_age=None):
+        '''
+        return (timestamp, temperature c, relative humidity)
+
+        A cached reading is returned if it is younger than max_age (or than
+        min_interval, whichever is longer). Raises IOError if every retry
+        failed.
+        '''
+        max_age = max(max_age or 0.0, self.min_interval)
+        with self.lock:
+            now = self.clock.time()
+            if self.last and now - self.last[0] < max_age:
+                return self.last
+            error = None
+            for attempt in range(self.retries + 1):
+                if self.last_transaction is not None:
+                    wait = self.last_transaction + self.min_interval - self.clock.time()
+                    if attempt > 0:
+                        wait += self.backoff * 2 ** (attempt - 1)
+                    if wait > 0:
+                        self.clock.sleep(wait)
+                self.last_transaction = self.clock.time()
+                try:
+                    temperature, humidity = self.transaction()
+                except (OSError, ValueError, KeyError) as e:
+                    error = e
+                    continue
+                self.last = (self.last_transaction, temperature, humidity)
+                return self.last
+            raise IOError('%s failed %d times: %s' % (self.dev, self.retries + 1, error))
+
+class FreqText:
+    ''' frequency from the text interface of the freq module, each read clears its buffer '''
+    def __init__(self, dev='/dev/freq'):
+        self.dev = dev
+        self.fd = None
+
+    def read(self):
+        # the freq driver ignores the file position, so the device is
+        # opened once and read repeatedly
+        if self.fd is None:
+            self.fd = os.open(self.dev, os.O_RDONLY)
+        try:
+            data = os.read(self.fd, 16)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        if not data:
+            raise IOError('no valid frequency from %s' % self.dev)
+        try:
+            return int(data.split(b'\0')[0])
+        except ValueError:
+            raise IOError('invalid frequency %s from %s' % (data, self.dev))
+
+class FreqRaw:
+    '''
+    frequency from the binary interface of the freq module
+
+    Reads struct freq_raw from freq_mod/freq.h. Nothing is cleared by a read,
+    so this can share the device with any number of other readers. Each
+    snapshot ends in end of file, so the device stays open and every read
+    starts over at offset 0.
+    '''
+    header = struct.Struct('=QqIIII')
+
+    def __init__(self, dev='/dev/freq_raw', max_age=1.0):
+        self.dev = dev
+        self.max_age = max_age # seconds without an edge before the signal is lost
+        self.fd = None
+
+    def read_raw(self):
+        ''' return seq, last_edge_ns, buf_ptr, min_freq, max_freq and the periods in ns '''
+        if self.fd is None:
+            self.fd = os.open(self.dev, os.O_RDONLY)
+        try:
+            data = os.pread(self.fd, 4096, 0)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        if len(data) < self.header.size:
+            raise IOError('short read from %s' % self.dev)
+        seq, last_edge_ns, buf_ptr, buffer_size, min_freq, max_freq = self.header.unpack_from(data)
+        periods = struct.unpack_from('=%dI' % buffer_size, data, self.header.size)
+        return seq, last_edge_ns, buf_ptr, min_freq, max_freq, periods
+
+    def read(self):
+        ''' average frequency in hz, same rules as the text interface '''
+        seq, last_edge_ns, buf_ptr, min_freq, max_freq, periods = self.read_raw()
+        if time.time_ns() - last_edge_ns > self.max_age * 1e9:
+            raise IOError('no signal on %s' % self.dev)
+        # glitchy edges are handled by summing rising and falling half periods
+        total = 0
+        count = 0
+        for i in range(0, len(periods) - 1, 2):
+            period = periods[i] + periods[i + 1]
+            if period and min_freq <= 1000000000 // period <= max_freq:
+                total += period
+                count += 1
+        if count <= len(periods) // 4:
+            raise IOError('no valid frequency from %s' % self.dev)
+        return 1000000000 // (total // count)
+
+def open_freq():
+    ''' prefer the non-destructive interface when the module provides it '''
+    if os.path.exists('/dev/freq_raw'):
+        return FreqRaw()
+    return FreqText()
+
+class HH10D:
+    '''
+    hh10d relative humidity sensor
+
+    The sensor's frequency is measured by the freq kernel module and its
+    calibration factors live in an m24c02 eeprom on i2c. The eeprom is only
+    read the first time; after that the factors come from cal_file.
+    '''
+    i2c_slave = 0x0703 # from linux/i2c-dev.h
+
+    def __init__(self, freq=None, i2c_dev='/dev/i2c-1', i2c_addr=0x51,
+                 cal_file='/var/cache/hh10d.json'):
+        self.freq = freq or open_freq()
+        self.i2c_dev = i2c_dev
+        self.i2c_addr = i2c_addr
+        self.cal_file = cal_file
+        self.sensitivity, self.offset = self.get_cal_factors()
+
+    def get_cal_factors(self):
+        try:
+            with open(self.cal_file) as fin:
+                cal = json.loads(fin.read())
+            return cal['sensitivity'], cal['offset']
+        except (IOError, ValueError, KeyError):
+            pass
+        sensitivity, offset = self.read_eeprom()
+        try:
+            with open(self.cal_file, 'w') as fout:
+                fout.write(json.dumps({ 'sensitivity' : sensitivity, 'offset' : offset }))
+        except IOError:
+            pass # still works, the eeprom just gets read again next start
+        return sensitivity, offset
+
+    def read_eeprom(self):
+        '''
+        the calibration factors are at eeprom addresses 10-13
+            10 sensitivity msb
+            11 sensitivity lsb
+            12 offset msb
+            13 offset lsb
+        '''
+        fd = os.open(self.i2c_dev, os.O_RDWR)
+        try:
+            fcntl.ioctl(fd, self.i2c_slave, self.i2c_addr)
+            os.write(fd, bytes([10]))
+            buf = os.read(fd, 4)
+        finally:
+            os.close(fd)
+        if len(buf) != 4:
+            raise IOError('short read from %s' % self.i2c_dev)
+        return buf[0] << 8 | buf[1], buf[2] << 8 | buf[3]
+
+    def read(self):
+        ''' return the relative humidity in percent, raise IOError if there's no valid reading '''
+        freq = self.freq.read()
+        return (self.offset - freq) * self.sensitivity / 4096.0
@@ -0,0 +1,13 @@
+import logging
+
+from logging.handlers import RotatingFileHandler
+
+def setup_logger(log_file, name='thermostat'):
+    formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s',
+                                  datefmt='%Y-%m-%d %H:%M:%S')
+    handler = RotatingFileHandler(log_file, maxBytes=1024*1024, backupCount=5)
+    handler.setFormatter(formatter)
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
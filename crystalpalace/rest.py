@@ -0,0 +1,56 @@
+# rest api shared by all controllers
+
+import flask
+import logging
+import threading
+
+from crystalpalace import control
+
+def make_api(ctl):
+    api = flask.Flask('state')
+
+    @api.route('/state', methods=['GET'])
+    def api_get_state():
+        return flask.jsonify(ctl.state)
+
+    @api.route('/button', methods=['POST'])
+    def api_push_button():
+        button = flask.request.get_data().decode("utf-8")
+        if not ctl.press(button):
+            return 'fail', 400
+        return 'success', 200
+
+    # batch of absolute settings, applied atomically:
+    #   {'ops' : {'set_temp' : 70, 'mode' : 'cool',
+    #             'sensors' : {'bedroom' : {'use_for_control' : False}}},
+    #    'expected_version' : 12, 'idempotency_key' : '...'}
+    # answers with the new state, or 409 and the current state if the
+    # settings changed since expected_version
+    @api.route('/command', methods=['POST'])
+    def api_command():
+        body = flask.request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            return flask.jsonify({ 'error' : 'invalid json' }), 400
+        try:
+            state = ctl.command(body.get('ops', {}), body.get('expected_version'),
+                                body.get('idempotency_key'))
+        except control.CommandError as e:
+            ctl.logger.warning('rejected command: %s' % e)
+            return flask.jsonify({ 'error' : str(e), 'state' : e.state }), e.status
+        return flask.jsonify(state)
+
+    return api
+
+def rest_thread_func(ctl, port):
+    api = make_api(ctl)
+
+    log = logging.getLogger('werkzeug')
+    log.setLevel(logging.ERROR)
+
+    api.run(host='0.0.0.0', port=port)
+
+def start(ctl, port):
+    rest_thread = threading.Thread(target=rest_thread_func, args=(ctl, port))
+    rest_thread.daemon = True
+    rest_thread.start()
+    return rest_thread
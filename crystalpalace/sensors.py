@@ -0,0 +1,254 @@
+# temperature and humidity sensor backends
+#
+# Every sensor belongs to a control.Controller (ctl) which provides the
+# state, clock, logger, polling rates and the sensor fusion.
+
+import subprocess
+import threading
+
+from crystalpalace import hal
+
+def c_to_f(c):
+    return c * 9.0 / 5.0 + 32.0
+
+def add_state(state, name, use_for_control):
+    ''' create the state entry for a sensor unless it was loaded from disk '''
+    if name not in state['sensors']:
+        state['sensors'][name] = { 'temperature' : None, 'use_for_control' : use_for_control }
+    return state['sensors'][name]
+
+class TempSensor:
+    ''' base class for temperature sensors '''
+    def __init__(self, ctl, name):
+        sensor_state = add_state(ctl.state, name, True)
+        sensor_state.setdefault('weight', 1.0)
+        self.ctl = ctl
+        self.name = name
+        self.row = ctl.fusion.add_sensor(name, ctl.clock.time(),
+                                         sensor_state['weight'],
+                                         sensor_state['use_for_control'])
+        self.poller = threading.Thread(target=self.poller_func)
+        self.poller.daemon = True
+        self.poller.start()
+        ctl.logger.info('added %s sensor' % name)
+
+    def poller_func(self):
+        while True:
+            self.ctl.clock.sleep(self.ctl.poll_rate)
+
+    @property
+    def use_for_control(self):
+        return bool(self.ctl.fusion.use_for_control[self.row])
+
+    @use_for_control.setter
+    def use_for_control(self, value):
+        self.ctl.fusion.set_use_for_control(self.row, value)
+
+    @property
+    def last_sample(self):
+        return self.ctl.fusion.last_sample[self.row]
+
+    def get_last(self):
+        return self.ctl.state['sensors'][self.name]
+
+    def get_average(self):
+        average = self.ctl.fusion.means[self.row]
+        if average != average: # nan
+            return None
+        return float(average)
+
+    def add_sample(self, sample):
+        self.ctl.state['sensors'][self.name]['temperature'] = round(sample)
+        self.ctl.fusion.add_sample(self.row, sample, self.ctl.clock.time())
+
+class ZMQTempSensor(TempSensor):
+    ''' remote temp sensor reporting through zmq socket '''
+    def __init__(self, ctl, name):
+        TempSensor.__init__(self, ctl, name)
+        self.address = ctl.zmq_address % name
+        self.subscriber = ctl.zmq_subscriber()
+        self.subscriber.connect(self.address)
+
+    def poller_func(self):
+        ctl = self.ctl
+        while True:
+            ctl.clock.sleep(ctl.poll_rate)
+            if ctl.clock.time() > self.last_sample + (ctl.timeout / 2):
+                ctl.logger.warning('%s: reconnecting' % self.name)
+                self.subscriber.reconnect(self.address)
+
+class W1TempSensor(TempSensor):
+    ''' ds18b20 temp sensor on the local 1-wire bus, read in-process '''
+    def __init__(self, ctl, name, address):
+        self.address = address
+        TempSensor.__init__(self, ctl, name)
+
+    def poller_func(self):
+        ctl = self.ctl
+        while True:
+            ctl.clock.sleep(ctl.poll_rate)
+            try:
+                temp_c = hal.read_w1_slave(self.address)
+            except IOError as e:
+                ctl.logger.warning('%s: %s reading %s' % (self.name, e, self.address))
+                continue
+            self.add_sample(c_to_f(temp_c))
+
+class CmdTempSensor(TempSensor):
+    ''' temp sensor accessible through shell command '''
+    def __init__(self, ctl, name, cmd):
+        self.cmd = cmd
+        TempSensor.__init__(self, ctl, name)
+
+    def poller_func(self):
+        ctl = self.ctl
+        logger = ctl.logger
+        while True:
+            ctl.clock.sleep(ctl.poll_rate)
+
+            try:
+                output = subprocess.check_output(self.cmd.split(), timeout=10)
+            except subprocess.CalledProcessError:
+                logger.warning('%s: CalledProcessError using command: %s' % (self.name, self.cmd))
+                continue
+            except subprocess.TimeoutExpired:
+                logger.warning('%s: TimeoutExpired using command: %s' % (self.name, self.cmd))
+                continue
+            except ValueError:
+                logger.warning('%s: ValueError using command: %s' % (self.name, self.cmd))
+                continue
+
+            if b'YES' not in output:
+                logger.warning('%s: CRC check failed using command: %s' % (self.name, self.cmd))
+                continue
+
+            try:
+                temp_str = output.split(b't=')[1].strip()
+            except IndexError:
+                logger.warning('%s: Unexpected format using command: %s' % (self.name, self.cmd))
+                continue
+
+            try:
+                temp_c = float(temp_str) / 1000.0
+            except ValueError:
+                logger.warning('%s: Invalid temperature "%s" using command: %s' % (self.name, temp_str, self.cmd))
+                continue
+
+            temp_f = c_to_f(temp_c)
+            self.add_sample(temp_f)
+
+class HumiditySensor:
+    ''' relative humidity reported alongside a temperature sensor '''
+    def __init__(self, ctl, name):
+        add_state(ctl.state, name, False)['humidity'] = None
+        self.ctl = ctl
+        self.name = name
+        self.last_sample = ctl.clock.time()
+        ctl.logger.info('added %s humidity sensor' % name)
+
+    def add_sample(self, sample):
+        self.ctl.state['sensors'][self.name]['humidity'] = round(sample)
+        self.last_sample = self.ctl.clock.time()
+
+class HH10DHumiditySensor(HumiditySensor):
+    ''' hh10d humidity sensor on this pi, read in-process '''
+    def __init__(self, ctl, name, hh10d):
+        HumiditySensor.__init__(self, ctl, name)
+        self.hh10d = hh10d
+        self.poller = threading.Thread(target=self.poller_func)
+        self.poller.daemon = True
+        self.poller.start()
+
+    def poller_func(self):
+        ctl = self.ctl
+        while True:
+            ctl.clock.sleep(ctl.poll_rate)
+            try:
+                rh = self.hh10d.read()
+            except (IOError, OSError) as e:
+                ctl.logger.warning('%s: %s reading humidity' % (self.name, e))
+                continue
+            self.add_sample(rh)
+
+class RHT03TempSensor(TempSensor):
+    ''' rht03 temperature and humidity sensor on this pi '''
+    def __init__(self, ctl, name, rht03):
+        self.rht03 = rht03
+        # a temperature sensor first, so it starts out used for control
+        add_state(ctl.state, name, True)
+        self.humidity = ctl.add_humidity_sensor(HumiditySensor(ctl, name))
+        TempSensor.__init__(self, ctl, name)
+
+    def poller_func(self):
+        ctl = self.ctl
+        last = None
+        while True:
+            ctl.clock.sleep(ctl.poll_rate)
+            try:
+                reading = self.rht03.read(ctl.poll_rate)
+            except IOError as e:
+                ctl.logger.warning('%s: %s' % (self.name, e))
+                continue
+            # only new conversions count as samples
+            if reading == last:
+                continue
+            last = reading
+            timestamp, temp_c, rh = reading
+            self.add_sample(c_to_f(temp_c))
+            self.humidity.add_sample(rh)
+
+class ZMQSubscriber:
+    ''' one zmq sub socket receiving from every temp_sensor.py in the house '''
+    def __init__(self, ctl):
+        import zmq
+        self.ctl = ctl
+        self.sock = zmq.Context.instance().socket(zmq.SUB)
+        self.sock.setsockopt_string(zmq.SUBSCRIBE, 'temperature')
+        self.sock.setsockopt_string(zmq.SUBSCRIBE, 'humidity')
+        self.thread = threading.Thread(target=self.sub_thread_func)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self, address):
+        self.sock.connect(address)
+
+    def reconnect(self, address):
+        self.sock.disconnect(address)
+        self.sock.connect(address)
+
+    def handle_humidity(self, name, value):
+        ctl = self.ctl
+        # any remote temperature sensor may also report humidity
+        if name not in ctl.humidity_sensors:
+            if name not in ctl.sensors:
+                ctl.logger.warning('unexpected zmq humidity sensor %s' % name)
+                return
+            ctl.add_humidity_sensor(HumiditySensor(ctl, name))
+        try:
+            rh = float(value)
+        except ValueError:
+            ctl.logger.warning('%s: Invalid humidity "%s" returned through zmq' % (name, value))
+            return
+        ctl.humidity_sensors[name].add_sample(rh)
+
+    def sub_thread_func(self):
+        ctl = self.ctl
+        logger = ctl.logger
+        while True:
+            string = self.sock.recv_string()
+            topic, name, value = string.split()
+            if topic == 'humidity':
+                self.handle_humidity(name, value)
+                continue
+            if topic != 'temperature':
+                logger.warning('unexpected zmq topic %s' % topic)
+                continue
+            if name not in ctl.sensors:
+                logger.warning('unexpected zmq sensor %s' % name)
+                continue
+            try:
+                temp_f = float(value)
+            except ValueError:
+                logger.warning('%s: Invalid temperature "%s" returned through zmq' % (name, value))
+                continue
+            ctl.sensors[name].add_sample(temp_f)
@@ -0,0 +1,22 @@
+# persistent thermostat state
+
+import copy
+import json
+import os
+
+def load(path, defaults, logger):
+    ''' load persistent settings if available, defaults otherwise '''
+    try:
+        with open(path) as fin:
+            return json.loads(fin.read())
+    except FileNotFoundError:
+        logger.warning('%s not found, using defaults' % path)
+        return copy.deepcopy(defaults)
+
+def save(path, state):
+    # write a new file and rename it so a crash never leaves a torn state file
+    with open(path + '.tmp', 'w') as fout:
+        fout.write(json.dumps(state, indent=4))
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(path + '.tmp', path)
@@ -4,18 +4,25 @@
 #include <linux/interrupt.h>
 #include <linux/miscdevice.h>
 #include <linux/module.h>
+#include <linux/slab.h>
+#include <linux/spinlock.h>
 #include <linux/time.h>
 #include <linux/uaccess.h>
 
+#include "freq.h"
+
 #define DEV_NAME "freq"
+#define RAW_DEV_NAME "freq_raw"
 #define DEFAULT_GPIO_PIN 17
 #define DEFAULT_MIN_FREQ 5000
 #define DEFAULT_MAX_FREQ 10000
-#define BUFFER_SIZE 256
+#define BUFFER_SIZE FREQ_BUFFER_SIZE
 
+static DEFINE_SPINLOCK(freq_lock);
 static struct timespec prev_time;
 static unsigned long ns_periods[BUFFER_SIZE];
 static int buf_ptr;
+static u64 edge_seq;
 static int gpio_pin = DEFAULT_GPIO_PIN;
 static int min_freq = DEFAULT_MIN_FREQ;
 static int max_freq = DEFAULT_MAX_FREQ;
@@ -29,11 +36,14 @@ static irqreturn_t freq_isr(int irq, void *data)
 	unsigned long ns;
 
 	getnstimeofday(&cur_time);
+	spin_lock(&freq_lock);
 	delta = timespec_sub(cur_time, prev_time);
 	ns = ((long long)delta.tv_sec * 1000000000) + delta.tv_nsec;
 	ns_periods[buf_ptr] = ns;
 	prev_time = cur_time;
 	buf_ptr = (buf_ptr + 1) % BUFFER_SIZE;
+	edge_seq++;
+	spin_unlock(&freq_lock);
 
 	return IRQ_HANDLED;
 }
@@ -43,6 +53,12 @@ static int freq_open(struct inode *inode, struct file *file)
 	return nonseekable_open(inode, file);
 }
 
+/* Unlike /dev/freq the raw device is seekable, pread() at 0 gets a new snapshot */
+static int freq_raw_open(struct inode *inode, struct file *file)
+{
+	return 0;
+}
+
 static int freq_release(struct inode *inode, struct file *file)
 {
 	return 0;
@@ -56,11 +72,11 @@ static ssize_t freq_write(struct file *file, const char __user *buf, size_t coun
 static ssize_t freq_read(struct file *file, char __user *buf, size_t count, loff_t *pos)
 {
 	int i, err, hz, s_count = 0;
-	unsigned long sample, sum = 0;
+	unsigned long sample, sum = 0, flags;
 	char str[16];
 
-	/* Sum the samples without interference from the ISR */
-	disable_irq(freq_irq);
+	/* Sum the samples without interference from the ISR or raw readers */
+	spin_lock_irqsave(&freq_lock, flags);
 	for (i = 0; i < BUFFER_SIZE; i += 2) {
 		sample = ns_periods[i] + ns_periods[i + 1];
 		hz = 1000000000 / sample;
@@ -71,7 +87,7 @@ static ssize_t freq_read(struct file *file, char __user *buf, size_t count, loff
 	}
 	memset(ns_periods, 0, sizeof ns_periods);
 	buf_ptr = 0;
-	enable_irq(freq_irq);
+	spin_unlock_irqrestore(&freq_lock, flags);
 
 	/* Average the samples if the majority are valid */
 	if (s_count > BUFFER_SIZE / 4) {
@@ -97,6 +113,47 @@ static ssize_t freq_read(struct file *file, char __user *buf, size_t count, loff
 	return s_count;
 }
 
+/* Copy a snapshot of the period buffer to userland without clearing it */
+static ssize_t freq_raw_read(struct file *file, char __user *buf, size_t count, loff_t *pos)
+{
+	int i;
+	ssize_t ret;
+	unsigned long flags;
+	struct freq_raw *raw;
+
+	/* One snapshot per read from the start, then end of file */
+	if (*pos >= sizeof *raw) {
+		return 0;
+	}
+	if (*pos != 0 || count < sizeof *raw) {
+		return -EINVAL;
+	}
+	raw = kmalloc(sizeof *raw, GFP_KERNEL);
+	if (raw == NULL) {
+		return -ENOMEM;
+	}
+
+	spin_lock_irqsave(&freq_lock, flags);
+	raw->seq = edge_seq;
+	raw->last_edge_ns = timespec_to_ns(&prev_time);
+	raw->buf_ptr = buf_ptr;
+	for (i = 0; i < BUFFER_SIZE; i++) {
+		raw->ns_periods[i] = ns_periods[i];
+	}
+	spin_unlock_irqrestore(&freq_lock, flags);
+	raw->buffer_size = BUFFER_SIZE;
+	raw->min_freq = min_freq;
+	raw->max_freq = max_freq;
+
+	ret = simple_read_from_buffer(buf, count, pos, raw, sizeof *raw);
+	kfree(raw);
+	if (ret < 0) {
+		printk(KERN_ERR "%s: simple_read_from_buffer returned %zd\n", __func__, ret);
+	}
+
+	return ret;
+}
+
 static struct file_operations freq_fops = {
 	.owner = THIS_MODULE,
 	.open = freq_open,
@@ -111,6 +168,22 @@ static struct miscdevice freq_misc_device = {
 	.fops = &freq_fops,
 };
 
+static struct file_operations freq_raw_fops = {
+	.owner = THIS_MODULE,
+	.open = freq_raw_open,
+	.llseek = default_llseek,
+	.read = freq_raw_read,
+	.write = freq_write,
+	.release = freq_release,
+};
+
+static struct miscdevice freq_raw_misc_device = {
+	.minor = MISC_DYNAMIC_MINOR,
+	.name = RAW_DEV_NAME,
+	.fops = &freq_raw_fops,
+	.mode = 0444,
+};
+
 static int __init freq_init(void){
 	int ret = 0;
 	printk(KERN_INFO "%s: start\n", __func__);
@@ -118,6 +191,7 @@ static int __init freq_init(void){
 	getnstimeofday(&prev_time);
 	memset(ns_periods, 0, sizeof ns_periods);
 	buf_ptr = 0;
+	edge_seq = 0;
 
 	ret = gpio_request(gpio_pin, "input");
 	if (ret) {
@@ -144,6 +218,7 @@ static int __init freq_init(void){
 	}
 
 	misc_register(&freq_misc_device);
+	misc_register(&freq_raw_misc_device);
 
 	printk(KERN_INFO "%s: gpio_pin=%d min_freq=%d max_freq=%d\n", __func__, gpio_pin, min_freq, max_freq);
 	printk(KERN_INFO "%s: end\n", __func__);
@@ -157,6 +232,7 @@ fail:
 static void __exit freq_exit(void){
 	printk(KERN_INFO "%s: start\n", __func__);
 
+	misc_deregister(&freq_raw_misc_device);
 	misc_deregister(&freq_misc_device);
 	free_irq(freq_irq, NULL);
 	gpio_free(gpio_pin);
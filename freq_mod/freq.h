@@ -0,0 +1,26 @@
+#ifndef FREQ_H
+#define FREQ_H
+
+#include <linux/types.h>
+
+#define FREQ_BUFFER_SIZE 256
+
+/*
+ * Snapshot returned by a read of /dev/freq_raw from offset 0, reads past it
+ * return end of file. Reading does not clear anything, so any number of
+ * readers can share the device. seq counts every edge since the module was
+ * loaded, so a reader can tell whether new periods arrived since its last
+ * read, and ns_periods[(buf_ptr - 1) % FREQ_BUFFER_SIZE]
+ * is the newest period. Two consecutive periods make up one full cycle.
+ */
+struct freq_raw {
+	__u64 seq;		/* edges recorded since load */
+	__s64 last_edge_ns;	/* wall clock time of the newest edge */
+	__u32 buf_ptr;		/* index the next period will be written to */
+	__u32 buffer_size;	/* FREQ_BUFFER_SIZE */
+	__u32 min_freq;		/* min_freq module parameter */
+	__u32 max_freq;		/* max_freq module parameter */
+	__u32 ns_periods[FREQ_BUFFER_SIZE]; /* time between edges in ns */
+};
+
+#endif /* FREQ_H */
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# aggregation hub for all of the thermostats in the house
+#
+# Each controller (thermostat/thermostat.py and every millivolt/thermostat.py
+# fireplace) serves its own /state and /button and publishes its state on a
+# zmq feed every trip through its control loop and after every button press
+# (crystalpalace/feed.py). Controllers advertise their feed over mdns and the
+# hub picks up every one avahi-browse reports, so adding a fireplace needs no
+# change here. The hub keeps one subscription to each controller, which zmq
+# holds open and reconnects by itself, and merges their states into
+# one cached, versioned view. Dashboards make one request to the hub instead
+# of one per controller, and the controllers see the same load no matter how
+# many dashboards are open.
+#
+#   GET  /state                 merged view, {'version': n, 'nodes': {...}}
+#                               honors If-None-Match with the version etag
+#   GET  /state?since=n         long poll, returns once the version passes n
+#   POST /button/<node>         forward a button press to one controller
+#   POST /button                forward a button press to every controller
+
+import flask
+import http.client
+import json
+import logging
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from crystalpalace import feed
+from crystalpalace import log
+
+offline_timeout = 20 # seconds without a state before a controller is offline
+request_timeout = 5 # seconds
+long_poll_timeout = 30 # seconds
+browse_retry = 10 # seconds before restarting avahi-browse if it exits
+rest_port = 5003
+
+log_file = '/var/log/thermostat/hub.log'
+
+nodes = {} # by name, only added to by the feed thread
+discovered = queue.Queue() # (name, host, feed port, rest port) from avahi-browse
+view = { 'version' : 0, 'nodes' : {} }
+view_json = json.dumps(view).encode('utf-8')
+view_cond = threading.Condition()
+
+logger = None
+def setup_logger():
+    global logger
+    logger = log.setup_logger(log_file, 'hub')
+
+def update_view(name, online, state):
+    ''' merge one controller's state into the view, bumping the version on change '''
+    global view_json
+    with view_cond:
+        entry = { 'online' : online, 'state' : state }
+        if view['nodes'].get(name) == entry:
+            return
+        view['nodes'][name] = entry
+        view['version'] += 1
+        view_json = json.dumps(view).encode('utf-8')
+        view_cond.notify_all()
+
+class Node:
+    ''' one controller, subscribed to through its state feed '''
+    def __init__(self, name, host, port, rest_port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.rest_port = rest_port # None if it has no rest api
+        self.online = False
+        self.last_state = None
+        self.sock = zmq.Context.instance().socket(zmq.SUB)
+        # only the newest state matters
+        self.sock.setsockopt(zmq.CONFLATE, 1)
+        self.sock.setsockopt_string(zmq.SUBSCRIBE, '')
+        self.sock.connect('tcp://%s:%d' % (host, port))
+
+    def request(self, method, path, body=None):
+        ''' return (status, body) of one request to the rest api '''
+        conn = http.client.HTTPConnection(self.host, self.rest_port, timeout=request_timeout)
+        try:
+            conn.request(method, path, body=body)
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        finally:
+            conn.close()
+
+    def receive(self, now):
+        try:
+            state = json.loads(self.sock.recv_string())
+        except ValueError as e:
+            logger.warning('%s: invalid state (%s)' % (self.name, e))
+            return
+        self.last_state = now
+        if not self.online:
+            logger.info('%s: online' % self.name)
+        self.online = True
+        update_view(self.name, True, state)
+
+    def check(self, now):
+        if self.online and now > self.last_state + offline_timeout:
+            logger.warning('%s: offline' % self.name)
+            self.online = False
+            update_view(self.name, False, view['nodes'].get(self.name, {}).get('state'))
+
+def parse_service(line):
+    '''
+    return (name, host, feed port, rest port) from a resolved service line of
+    avahi-browse -p, None for any other line
+
+    example: =;eth0;IPv4;livingroom;_crystalpalace._tcp;local;livingroom.local;192.168.1.20;5556;"rest=5000"
+    '''
+    fields = line.split(';')
+    if len(fields) < 10 or fields[0] != '=':
+        return None
+    # avahi escapes names as \ddd decimal bytes
+    name = re.sub(r'\\(\d{3})', lambda m: chr(int(m.group(1))), fields[3])
+    rest_port = re.search(r'"rest=(\d+)"', fields[9])
+    try:
+        return name, fields[6], int(fields[8]), int(rest_port.group(1)) if rest_port else None
+    except ValueError:
+        return None
+
+def browse_thread_func():
+    # runs as long as the hub, reporting controllers as they appear
+    cmd = ['avahi-browse', '--parsable', '--resolve', '--no-db-lookup', feed.service_type]
+    while True:
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    universal_newlines=True)
+        except OSError as e:
+            logger.error('can\'t discover controllers, avahi-browse failed: %s' % e)
+            return
+        for line in proc.stdout:
+            service = parse_service(line.strip())
+            if service:
+                discovered.put(service)
+        proc.wait()
+        logger.warning('avahi-browse exited with %d, restarting' % proc.returncode)
+        time.sleep(browse_retry)
+
+def add_node(poller, sockets, name, host, port, rest_port):
+    # every controller is reported once per address family, and again when
+    # it comes back
+    old = nodes.get(name)
+    if old:
+        if (old.host, old.port, old.rest_port) == (host, port, rest_port):
+            return
+        poller.unregister(old.sock)
+        del sockets[old.sock]
+        old.sock.close(0)
+    logger.info('%s: found at %s:%d' % (name, host, port))
+    node = Node(name, host, port, rest_port)
+    if old:
+        node.online, node.last_state = old.online, old.last_state
+    poller.register(node.sock, zmq.POLLIN)
+    sockets[node.sock] = node
+    nodes[name] = node
+
+def feed_thread_func():
+    # zmq sockets are not thread safe, so this thread owns all of them
+    poller = zmq.Poller()
+    sockets = {}
+    while True:
+        while not discovered.empty():
+            add_node(poller, sockets, *discovered.get())
+        events = dict(poller.poll(1000))
+        now = time.monotonic()
+        for sock in events:
+            sockets[sock].receive(now)
+        for node in list(nodes.values()):
+            node.check(now)
+
+def push_button(node, button):
+    # the controller publishes its new state right away
+    try:
+        status, data = node.request('POST', '/button', button.encode('utf-8'))
+    except (OSError, http.client.HTTPException) as e:
+        logger.warning('%s: button %s failed (%s)' % (node.name, button, e))
+        return 502
+    return status
+
+def rest_thread_func():
+    api = flask.Flask('hub')
+
+    log = logging.getLogger('werkzeug')
+    log.setLevel(logging.ERROR)
+
+    @api.route('/state', methods=['GET'])
+    def api_get_state():
+        since = flask.request.args.get('since', type=int)
+        with view_cond:
+            if since is not None:
+                view_cond.wait_for(lambda: view['version'] > since, long_poll_timeout)
+            version = view['version']
+            body = view_json
+        etag = str(version)
+        if flask.request.if_none_match.contains(etag):
+            return '', 304, { 'ETag' : '"%s"' % etag }
+        return flask.Response(body, mimetype='application/json', headers={ 'ETag' : '"%s"' % etag })
+
+    @api.route('/button', methods=['POST'])
+    @api.route('/button/<name>', methods=['POST'])
+    def api_push_button(name=None):
+        button = flask.request.get_data().decode("utf-8")
+        targets = [node for node in list(nodes.values())
+                   if node.online and node.rest_port and (name is None or node.name == name)]
+        if not targets:
+            return 'unknown controller', 404
+        statuses = [push_button(node, button) for node in targets]
+        logger.info('user pressed button %s on %s' % (button, name or 'all'))
+        if all(status == 200 for status in statuses):
+            return 'success', 200
+        return 'fail', max(statuses)
+
+    api.run(host='0.0.0.0', port=rest_port, threaded=True)
+
+def main():
+    browse_thread = threading.Thread(target=browse_thread_func)
+    browse_thread.daemon = True
+    browse_thread.start()
+
+    feed_thread = threading.Thread(target=feed_thread_func)
+    feed_thread.daemon = True
+    feed_thread.start()
+
+    rest_thread_func()
+
+if __name__ == '__main__':
+    setup_logger()
+    try:
+        main()
+    except BaseException as e:
+        logger.error(traceback.format_exc())
+        raise
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# accelerated time benchmark of the thermostat control loop
+#
+# Runs thermostat.main() against the simulated house in sim.py for a number
+# of simulated days at each sensor count and reports the cost of one control
+# loop iteration, memory growth and how far the reported duty cycle is from
+# the relay on-time actually recorded. Every sensor count runs in a fresh
+# process so module state and memory measurements don't leak between runs.
+#
+# example: ./bench.py --days 2 --sensors 5,20,100
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+def rss_kb():
+    with open('/proc/self/statm') as fin:
+        pages = int(fin.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def run(args):
+    import sim
+    import thermostat
+    from crystalpalace import hal
+
+    end = args.days * 86400
+    clock = hal.SimClock(end=end)
+    house = sim.House(clock, args.sensors, kinds=args.kinds.split(','),
+                      faulty=args.faulty, seed=args.seed)
+
+    memory = []
+    def sample_memory(now, dt):
+        if not memory or now >= memory[-1][0] + 3600:
+            memory.append((now, rss_kb()))
+    clock.advance_hooks.append(sample_memory)
+
+    # the state file and log only live as long as the run
+    with tempfile.TemporaryDirectory(prefix='thermostat-bench-') as workdir:
+        sim.install(thermostat, house, workdir)
+        thermostat.setup_logger()
+        start = time.perf_counter()
+        try:
+            thermostat.main()
+        except hal.SimulationComplete:
+            pass
+        wall = time.perf_counter() - start
+
+    now = clock.time()
+    window = min(24 * 60 * 60, now - 30)
+    on_time = sum(house.relays[pin].on_time(now - window, now) for pin in (sim.heat_pin, sim.ac_pin))
+    true_duty = 100.0 * on_time / window
+    # skip the first hour so startup allocations don't count as growth
+    baseline = memory[1][1] if len(memory) > 1 else memory[0][1]
+
+    return {
+        'sensors' : args.sensors,
+        'days' : args.days,
+        'loops' : clock.loops,
+        'loop_us' : 1e6 * clock.busy_time / max(clock.loops, 1),
+        'wall_s' : wall,
+        'speedup' : now / wall,
+        'rss_kb' : memory[-1][1],
+        'rss_growth_kb' : memory[-1][1] - baseline,
+        'duty_cycle' : thermostat.ctl.state['duty_cycle'],
+        'true_duty_cycle' : true_duty,
+        'duty_cycle_error' : thermostat.ctl.state['duty_cycle'] - true_duty,
+        'house_average' : house.average(),
+        'set_temp' : thermostat.ctl.state['set_temp'],
+        'outliers' : sum(1 for name in thermostat.ctl.sensors if thermostat.ctl.state['sensors'][name]['outlier']),
+    }
+
+def main(args):
+    parser = argparse.ArgumentParser(description='thermostat control loop benchmark')
+    parser.add_argument('--days', type=float, default=1.0, help='simulated days per run')
+    parser.add_argument('--sensors', default='5,20,50,100', help='comma separated sensor counts')
+    parser.add_argument('--kinds', default='w1,zmq', help='sensor backends to rotate through (w1, zmq, cmd)')
+    parser.add_argument('--faulty', type=int, default=0, help='number of probes reading far too cold')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print raw json results')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(args[1:])
+
+    if args.run:
+        args.sensors = int(args.sensors)
+        print(json.dumps(run(args)))
+        return 0
+
+    results = []
+    for count in args.sensors.split(','):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run',
+                                          '--days', str(args.days), '--sensors', count,
+                                          '--kinds', args.kinds, '--faulty', str(args.faulty),
+                                          '--seed', str(args.seed)])
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+        results.append(result)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('%4d sensors: %8.1f us/loop %6.1fx realtime rss %6d kB (+%d kB) '
+                  'duty %3d%% actual %5.1f%% house %.1f F outliers %d' %
+                  (result['sensors'], result['loop_us'], result['speedup'],
+                   result['rss_kb'], result['rss_growth_kb'], result['duty_cycle'],
+                   result['true_duty_cycle'], result['house_average'], result['outliers']))
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
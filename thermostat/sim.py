@@ -0,0 +1,209 @@
+# simulated house for running the thermostat off the pi
+#
+# The house is a lumped thermal model with one node per zone. Each zone leaks
+# heat to the outside, gains heat while the furnace runs, loses it while the
+# ac runs and is mixed toward the house average whenever the blower is moving
+# air. Zone temperatures are reported through the same paths the real sensors
+# use: a fake sysfs tree of ds18b20 w1_slave files, zmq publishers like
+# temp_sensor.py and shell commands.
+
+import math
+import os
+import random
+import threading
+import sys
+import time
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from crystalpalace import hal
+from crystalpalace import sensors
+
+heat_pin = 22
+fan_pin = 23
+ac_pin = 24
+
+class Zone:
+    ''' one room of the simulated house '''
+    def __init__(self, name, temp, tau, heat_rate, cool_rate, kind):
+        self.name = name
+        self.temp = temp # degrees f
+        self.tau = tau # seconds, time constant of heat loss to outside
+        self.heat_rate = heat_rate # degrees f per second with heat on
+        self.cool_rate = cool_rate # degrees f per second with ac on
+        self.kind = kind # how the zone is reported: w1, zmq or cmd
+        self.address = None
+        self.probe_error = 0.0 # degrees f added to every reading
+
+class House:
+    ''' thermal model of a house driven by the thermostat relays '''
+    def __init__(self, clock, zone_count=5, kinds=('w1', 'zmq'), start_temp=66.0,
+                 outside_mean=30.0, outside_swing=10.0, noise=0.1, faulty=0, seed=0):
+        self.clock = clock
+        self.outside_mean = outside_mean
+        self.outside_swing = outside_swing
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.relays = {}
+        self.zones = []
+        for i in range(zone_count):
+            self.zones.append(Zone('zone%d' % i,
+                                   start_temp + self.random.uniform(-2.0, 2.0),
+                                   self.random.uniform(3.0, 6.0) * 3600,
+                                   self.random.uniform(0.004, 0.007),
+                                   self.random.uniform(0.003, 0.005),
+                                   kinds[i % len(kinds)]))
+        # failing probes read far too cold, as if they had fallen out a window
+        for zone in self.zones[:faulty]:
+            zone.probe_error = -30.0
+        clock.advance_hooks.append(self.step)
+
+    def relay(self, pin):
+        self.relays[pin] = hal.SimRelay(pin, self.clock)
+        return self.relays[pin]
+
+    def relay_value(self, pin):
+        if pin in self.relays:
+            return self.relays[pin].value
+        return 0
+
+    def outside(self, now):
+        return self.outside_mean + self.outside_swing * math.sin(2 * math.pi * now / 86400)
+
+    def step(self, now, dt):
+        if dt <= 0:
+            return
+        heat = self.relay_value(heat_pin)
+        ac = self.relay_value(ac_pin)
+        blower = heat or ac or self.relay_value(fan_pin)
+        outside = self.outside(now)
+        average = sum(zone.temp for zone in self.zones) / len(self.zones)
+        for zone in self.zones:
+            rate = (outside - zone.temp) / zone.tau
+            rate += heat * zone.heat_rate - ac * zone.cool_rate
+            if blower:
+                rate += (average - zone.temp) / 1800.0
+            zone.temp += rate * dt
+
+    def reading(self, zone):
+        ''' temperature a probe in the zone reports, in degrees f '''
+        return zone.temp + zone.probe_error + self.random.gauss(0.0, self.noise)
+
+    def average(self):
+        return sum(zone.temp for zone in self.zones) / len(self.zones)
+
+def f_to_c(f):
+    return (f - 32.0) * 5.0 / 9.0
+
+class FakeSysfs:
+    ''' directory tree laid out like /sys with ds18b20 w1_slave files '''
+    def __init__(self, root):
+        self.root = root
+        self.master = os.path.join(root, 'devices', 'w1_bus_master1')
+        self.bus = os.path.join(root, 'bus', 'w1', 'devices')
+        os.makedirs(self.master, exist_ok=True)
+        os.makedirs(self.bus, exist_ok=True)
+
+    def add(self, address):
+        os.makedirs(os.path.join(self.master, address), exist_ok=True)
+        link = os.path.join(self.bus, address)
+        if not os.path.islink(link):
+            os.symlink(os.path.join(self.master, address), link)
+
+    def write(self, address, temp_c, crc_ok=True):
+        raw = '4b 01 4b 46 7f ff 05 10 e1'
+        text = '%s : crc=e1 %s\n%s t=%d\n' % (raw, 'YES' if crc_ok else 'NO', raw, round(temp_c * 1000))
+        path = os.path.join(self.master, address, 'w1_slave')
+        with open(path + '.tmp', 'w') as fout:
+            fout.write(text)
+        os.replace(path + '.tmp', path)
+
+class FakeZMQPublisher:
+    ''' zmq publishers speaking the temp_sensor.py protocol, one per zone '''
+    def __init__(self, house, ctx, address):
+        self.house = house
+        self.zones = [zone for zone in house.zones if zone.kind == 'zmq']
+        self.socks = {}
+        self.sent_at = None
+        for zone in self.zones:
+            sock = ctx.socket(zmq.PUB)
+            sock.bind(address % zone.name)
+            self.socks[zone.name] = sock
+
+    def publish(self):
+        for zone in self.zones:
+            self.socks[zone.name].send_string('temperature %s %f' % (zone.name, self.house.reading(zone)))
+        self.sent_at = self.house.clock.time()
+
+    def run(self, poll_rate):
+        while True:
+            self.house.clock.sleep(poll_rate)
+            self.publish()
+
+    def start(self, poll_rate):
+        thread = threading.Thread(target=self.run, args=(poll_rate,))
+        thread.daemon = True
+        thread.start()
+
+def install(thermostat, house, workdir, settle_timeout=0.2):
+    '''
+    point the thermostat module at the simulated house
+
+    Everything the daemon touches (clock, relays, 1-wire sysfs, zmq endpoints,
+    state and log files) is redirected into workdir and the house model.
+    '''
+    clock = house.clock
+    thermostat.clock = clock
+    thermostat.Relay = house.relay
+    thermostat.rest_port = None
+    thermostat.feed_port = None
+    thermostat.zmq_address = 'inproc://%s'
+    thermostat.log_file = os.path.join(workdir, 'thermostat.log')
+    thermostat.persistent_state_file = os.path.join(workdir, 'state.json')
+    hal.sysfs_root = os.path.join(workdir, 'sys')
+
+    sysfs = FakeSysfs(hal.sysfs_root)
+    for i, zone in enumerate(house.zones):
+        if zone.kind in ('w1', 'cmd'):
+            zone.address = '28-%012x' % (0x3c73f29 + i)
+            sysfs.add(zone.address)
+            sysfs.write(zone.address, f_to_c(house.reading(zone)))
+    publisher = FakeZMQPublisher(house, zmq.Context.instance(), thermostat.zmq_address)
+
+    last_write = [None]
+    def update_sysfs(now, dt):
+        # ds18b20s convert at most about once a second
+        if last_write[0] is not None and now < last_write[0] + 1.0:
+            return
+        last_write[0] = now
+        for zone in house.zones:
+            if zone.address:
+                sysfs.write(zone.address, f_to_c(house.reading(zone)))
+
+    def wait_for_zmq(now):
+        # the subscriber thread is not clocked, give it a moment to drain
+        if publisher.sent_at != now:
+            return
+        deadline = time.monotonic() + settle_timeout
+        for zone in publisher.zones:
+            sensor = thermostat.ctl.sensors.get(zone.name)
+            while sensor and sensor.last_sample < now and time.monotonic() < deadline:
+                time.sleep(0)
+
+    clock.advance_hooks.append(update_sysfs)
+    clock.settle_hooks.append(wait_for_zmq)
+
+    def init_sensors(ctl):
+        for zone in house.zones:
+            if zone.kind == 'w1':
+                sensor = sensors.W1TempSensor(ctl, zone.name, zone.address)
+            elif zone.kind == 'cmd':
+                sensor = sensors.CmdTempSensor(ctl, zone.name, 'cat %s' % hal.w1_slave_path(zone.address))
+            else:
+                sensor = sensors.ZMQTempSensor(ctl, zone.name)
+            ctl.add_sensor(sensor)
+        publisher.start(ctl.poll_rate)
+
+    thermostat.init_sensors = init_sensors
+    return sysfs, publisher
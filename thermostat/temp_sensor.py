@@ -2,41 +2,20 @@
 
 import os
 import socket
+import sys
 import time
 import zmq
 
-def get_temp(address):
-    reading_valid = False
-    temperature = 0.0
-    with open('/sys/bus/w1/devices/%s/w1_slave' % address) as fin:
-        for line in fin:
-            if 'YES' in line:
-                reading_valid = True
-            if 't=' in line:
-                t = line.split('t=')[1].strip()
-                temperature = float(t) / 1000
-    if reading_valid:
-        return temperature
-    raise IOError # failed open for no such file also raises IOError
-
-def c_to_f(c):
-    return c * 9.0 / 5.0 + 32.0
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from crystalpalace import hal
+from crystalpalace import sensors
 
 if __name__ == '__main__':
 
     location = socket.gethostname()
 
-    # find the temp sensor address
-    # example: /sys/devices/w1_bus_master1/28-000003c73f29/w1_slave
-    #                                      ^^^^^^^^^^^^^^^
-    address = None
-    while True:
-        for d in os.listdir('/sys/devices/w1_bus_master1'):
-            if d.startswith('28-'):
-                address = d
-        if address:
-            break
-        time.sleep(1)
+    address = hal.find_w1_slave(hal.Clock())
     print('found temp sensor %s' % address)
 
     # set up the zmq publisher
@@ -44,13 +23,27 @@ if __name__ == '__main__':
     pub_sock = zmq_ctx.socket(zmq.PUB)
     pub_sock.bind('tcp://*:5555')
 
-    # poll the sensor
+    # use the hh10d humidity sensor too if the freq module is loaded
+    hh10d = None
+    if os.path.exists('/dev/freq'):
+        try:
+            hh10d = hal.HH10D()
+            print('found humidity sensor')
+        except (IOError, OSError) as e:
+            print('hh10d not available: %s' % e)
+
+    # poll the sensors
     while True:
         try:
-            c_temp = get_temp(address)
+            c_temp = hal.read_w1_slave(address)
         except IOError:
             time.sleep(1)
             continue
-        f_temp = c_to_f(c_temp)
+        f_temp = sensors.c_to_f(c_temp)
         pub_sock.send_string('temperature %s %f' % (location, f_temp))
+        if hh10d:
+            try:
+                pub_sock.send_string('humidity %s %f' % (location, hh10d.read()))
+            except (IOError, OSError):
+                pass
         time.sleep(5)